@@ -0,0 +1,267 @@
+"""
+Headless benchmark of the server simulation. Matches are run by a real TinyServer, but its clients are stand-ins with
+no sockets behind them, so the numbers cover the simulation and message encoding and nothing else.
+
+Each case keeps a steady number of bullets in flight in every match by having the ships fire as bullets leave the
+screen, and times the work the server does each tick (TinyServer.tick() followed by Pump()). Ships can't be destroyed,
+so the battle lasts the whole run. Every case runs in its own process so that its peak memory use is its own.
+
+Results are printed as a table, and can also be written as JSON with --json for tracking regressions between releases,
+e.g. `python benchmark.py --bullets 100 1000 10000 --json bench.json`.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import resource
+import multiprocessing
+from timeit import default_timer
+import numpy
+import wire
+import server
+from simulation import PLAYERS, MAX_PLAYERS
+
+# Bumped whenever the layout of the JSON results changes
+RESULTS_VERSION = 1
+
+# Health given to every ship, so none are destroyed however many bullets hit them
+BENCH_HEALTH = 10 ** 9
+
+# Largest move and turn (in steps) a ship makes in a command frame
+MAX_MOVE = 8
+MAX_TURN = 3
+
+# Latency percentiles reported
+PERCENTILES = (50, 90, 99)
+
+
+class NullSocket(object):
+    """
+    Stands in for a client's socket. The benchmark never reads from or writes to it.
+    """
+    def fileno(self):
+        return -1
+
+
+class BenchChannel(server.ServerChannel):
+    """
+    A client with nothing connected to it. Messages queued for it are counted and thrown away when the server is
+    pumped, after they've been encoded and coalesced as usual. Bullet snapshots are acknowledged as soon as they're
+    sent, so the server sees them acknowledged a tick later.
+    """
+    def __init__(self, number, bench_server):
+        """
+        Set up the client.
+        :int number: Client number, used as its address
+        :TinyServer bench_server: Server running the benchmark
+        :return: None
+        """
+        server.ServerChannel.__init__(self, NullSocket(), ("bench", number), bench_server)
+        self.sent_bytes = 0
+        self.sent_snapshot = None  # Latest bullet snapshot sent
+        self.command = 0  # Number of the last command frame sent
+
+    def Send(self, data, stream=None, barrier=False):
+        if data["action"] == "delta":
+            self.sent_snapshot = data["s"]
+        return server.ServerChannel.Send(self, data, stream, barrier)
+
+    def flush(self):
+        self.sent_bytes += self._obuffer_size
+        self._obuffer = list()
+        self._obuffer_size = 0
+        self._streams = dict()
+        if self.sent_snapshot is not None:
+            self.Network_ack({"action": "ack", "s": self.sent_snapshot})
+
+    def send_command(self):
+        """
+        Move the ship at random, as if the client had sent a command frame.
+        :return: None
+        """
+        self.command += 1
+        self.Network_cmd({"action": "cmd", "n": self.command, "b": 0,
+                          "m": [random.randint(-MAX_MOVE, MAX_MOVE), random.randint(-MAX_MOVE, MAX_MOVE),
+                                random.randint(-MAX_TURN, MAX_TURN)]})
+
+
+def time_calls(obj, name, totals):
+    """
+    Replace a method with one that adds up the time spent in it.
+    :obj: Object whose method to time
+    :str name: Name of the method
+    :dict totals: Name -> total seconds, updated with each call
+    :return: None
+    """
+    method = getattr(obj, name)
+    totals.setdefault(name, 0.0)
+
+    def timed(*args, **kwargs):
+        start = default_timer()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            totals[name] += default_timer() - start
+    setattr(obj, name, timed)
+
+
+def peak_memory():
+    """
+    Peak memory use of this process.
+    :return: Peak resident set size in kilobytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # Bytes on Mac OS X, kilobytes elsewhere
+
+
+def run_case(bullets, ships, matches, ticks, warmup, bullet_sync, seed):
+    """
+    Run one benchmark case.
+    :int bullets: Bullets kept in flight in each match
+    :int ships: Ships in each match
+    :int matches: Number of matches
+    :int ticks: Ticks to time
+    :int warmup: Ticks to run first, without timing them, so the bullets spread out
+    :str bullet_sync: Bullet sync mode (see server.BULLET_SYNC_MODES)
+    :int seed: Random seed
+    :return: dict of results
+    """
+    random.seed(seed)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")  # The server logs every player joining
+    try:
+        bench_server = server.TinyServer(localaddr=None, bullet_sync=bullet_sync, players=ships)
+        channels = list()
+        for number in xrange(ships * matches):
+            channel = BenchChannel(number, bench_server)
+            bench_server.add_channel(channel)
+            channel.ship.health = BENCH_HEALTH
+            channels.append(channel)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    phases = dict()
+    for match in bench_server.matches:
+        for name in ("handle_bullets", "handle_bullet_hits", "remove_stray_bullets", "gen_bullet_locs", "send_deltas",
+                     "send_despawns"):
+            time_calls(match, name, phases)
+        time_calls(match.projectiles, "update", phases)
+
+    latencies = list()
+    bullet_updates = 0
+    for tick in xrange(warmup + ticks):
+        # Steer every ship, and fire to keep each match's bullet count up
+        for channel in channels:
+            channel.send_command()
+        for match in bench_server.matches:
+            players = match.players
+            for shot in xrange(bullets - len(match.projectiles)):
+                random.choice(players).fire()
+        if tick == warmup:
+            for name in phases:
+                phases[name] = 0.0
+            for channel in channels:
+                channel.sent_bytes = 0
+
+        live = sum(len(match.projectiles) for match in bench_server.matches)
+        start = default_timer()
+        bench_server.tick()
+        bench_server.Pump()
+        elapsed = default_timer() - start
+        if tick >= warmup:
+            latencies.append(elapsed)
+            bullet_updates += live
+
+    latencies = numpy.array(latencies) * 1000
+    total = latencies.sum() / 1000
+    result = {"bullets": bullets, "ships": ships, "matches": matches, "ticks": ticks, "bullet_sync": bullet_sync,
+              "seed": seed,
+              "tick_ms": dict([("mean", float(latencies.mean())), ("max", float(latencies.max()))]
+                              + [("p" + str(p), float(numpy.percentile(latencies, p))) for p in PERCENTILES]),
+              "phase_ms": dict((name, seconds * 1000 / ticks) for name, seconds in phases.iteritems()),
+              "ticks_per_second": ticks / total if total else None,
+              "bullet_updates_per_second": bullet_updates / total if total else None,
+              "sent_bytes_per_tick": sum(channel.sent_bytes for channel in channels) / float(ticks),
+              "peak_rss_kb": peak_memory()}
+    return result
+
+
+def run_case_process(queue, args):
+    queue.put(run_case(*args))
+
+
+def run_isolated(*args):
+    """
+    Run a benchmark case in a new process.
+    :return: dict of results (see run_case())
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_case_process, args=(queue, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def print_table(results):
+    """
+    Print benchmark results for people to read.
+    :list results: Results from run_case()
+    :return: None
+    """
+    print "%8s %6s %8s %7s %9s %9s %9s %9s %14s %10s" % ("bullets", "ships", "matches", "sync", "mean ms", "p50 ms",
+                                                          "p99 ms", "max ms", "bullet upd/s", "peak MB")
+    for result in results:
+        tick_ms = result["tick_ms"]
+        print "%8d %6d %8d %7s %9.3f %9.3f %9.3f %9.3f %14.0f %10.1f" % (
+            result["bullets"], result["ships"], result["matches"], result["bullet_sync"], tick_ms["mean"],
+            tick_ms["p50"], tick_ms["p99"], tick_ms["max"], result["bullet_updates_per_second"],
+            result["peak_rss_kb"] / 1024.0)
+        print "%8s time per tick: " % "" + ", ".join(
+            name + " " + "%.3f" % ms + " ms" for name, ms in sorted(result["phase_ms"].items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiny Space Battles server simulation benchmark")
+    parser.add_argument("--bullets", type=int, nargs="+", default=[100, 1000, 10000], metavar="N",
+                        help="bullets in flight in each match (one case per value, default: 100 1000 10000)")
+    parser.add_argument("--ships", type=int, nargs="+", default=[PLAYERS], metavar="N",
+                        help="ships in each match (one case per value, default: " + str(PLAYERS) + ")")
+    parser.add_argument("--matches", type=int, default=1, help="matches run by the server")
+    parser.add_argument("--ticks", type=int, default=600, help="ticks to time in each case")
+    parser.add_argument("--warmup", type=int, default=180, help="ticks to run before timing starts")
+    parser.add_argument("--bullet-sync", choices=server.BULLET_SYNC_MODES, default=server.BULLET_SYNC,
+                        help="how bullets are sent to clients (see server.py --help)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--dict-wire", action="store_true", help="send move and bullets messages as plain dicts")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON to PATH (- for stdout only)")
+    args = parser.parse_args()
+    for ships in args.ships:
+        if not 2 <= ships <= MAX_PLAYERS:
+            parser.error("--ships must be between 2 and " + str(MAX_PLAYERS))
+    wire.binary = not args.dict_wire
+
+    results = list()
+    for ships in args.ships:
+        for bullets in args.bullets:
+            results.append(run_isolated(bullets, ships, args.matches, args.ticks, args.warmup, args.bullet_sync,
+                                        args.seed))
+    if args.json != "-":
+        print_table(results)
+
+    if args.json:
+        report = {"version": RESULTS_VERSION,
+                  "python": platform.python_version(),
+                  "numpy": numpy.__version__,
+                  "platform": platform.platform(),
+                  "wire": "dict" if args.dict_wire else "binary",
+                  "warmup": args.warmup,
+                  "results": results}
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
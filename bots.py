@@ -0,0 +1,443 @@
+"""
+Headless bots for load testing a server (or the matchmaker). Each bot is a client without a window: it connects, takes
+a seat, places its ship and then sends command frames like the real client, moving and firing at random at the rates
+given on the command line, and asks for a restart when its battle is over. Hundreds of bots can be run from one
+process, e.g. `python bots.py localhost:31425 --bots 200`.
+
+Bots handle the server's messages with the same Network_<action> callbacks as the client. TCP bots share one asyncore
+map, so one poll covers all of their sockets.
+
+While running, and again at the end, the bots report:
+* How long connecting took (until the server said "connected") and how long until they were seated in a match
+* Round-trip time of command frames, from sending a frame to the server confirming it has applied it
+* Command frames that were late (confirmed after --late milliseconds) or dropped (never confirmed)
+* Command frames the bots skipped because this process fell behind (if this isn't 0, the numbers measure the load
+  generator rather than the server, so use fewer bots per process)
+
+Run the bots on a different machine (or at least a different core) from the server, or the two compete for the CPU and
+the round trips measure that contention as much as the server.
+"""
+import sys
+import json
+import math
+import random
+import argparse
+import asyncore
+from time import time, sleep
+from collections import deque
+from PodSixNet.Channel import Channel
+from PodSixNet.EndPoint import EndPoint as TCPEndPoint
+import wire
+from datagram import EndPoint as DatagramEndPoint
+from scheduler import FixedTimestep
+from transport import raise_fd_limit
+from simulation import PLAYERS, MOVE_STEP, FIRE, player_slot, start_position
+
+# Command frames per second, as sent by the real client
+COMMAND_RATE = 60
+
+# Default rates for the bots' behaviour: command frames a second with movement, and shots a second
+MOVE_RATE = 30
+FIRE_RATE = 2
+
+# Default seconds a bot waits after a battle is over before asking for a restart
+RESTART_DELAY = 2
+
+# Default round trip in milliseconds past which a command frame counts as late
+LATE_FRAME_MS = 100
+
+# Seconds after which a command frame that hasn't been confirmed counts as dropped
+DROPPED_FRAME = 2
+
+# Chance each moving frame that a bot picks a new direction
+TURN_CHANCE = 0.05
+
+# Seconds between progress reports
+REPORT_INTERVAL = 5
+
+# Most time to wait for network traffic between passes over the bots
+POLL_TIMEOUT = 0.002
+
+# Latency percentiles reported
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of values.
+    :list values: Values
+    :float p: Percentile (0-100)
+    :return: The value, or None if there aren't any
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+
+def summarize(values):
+    """
+    Summarize a list of times in seconds.
+    :list values: Times in seconds
+    :return: dict of count, mean, percentiles and max, in milliseconds
+    """
+    summary = {"count": len(values)}
+    if values:
+        summary["mean"] = sum(values) * 1000 / len(values)
+        summary["max"] = max(values) * 1000
+        for p in PERCENTILES:
+            summary["p" + str(p)] = percentile(values, p) * 1000
+    return summary
+
+
+class Stats(object):
+    """
+    Measurements shared by every bot.
+    """
+    def __init__(self):
+        self.connect_times = list()  # Seconds from starting to connect until the server said "connected"
+        self.seat_times = list()  # Seconds from starting to connect until taking a seat in a match
+        self.round_trips = list()  # Seconds from sending each confirmed command frame until it was confirmed
+        self.frames_sent = 0
+        self.frames_late = 0
+        self.frames_dropped = 0
+        self.passes = list()  # Seconds taken by each pass over the bots
+        self.messages = 0  # Messages received from the server
+        self.errors = 0
+        self.disconnects = 0
+
+
+class Bot(object):
+    """
+    A headless client with scripted behaviour.
+    """
+    def __init__(self, number, address, stats, options, tcp_map=None, udp=False):
+        """
+        Set up the bot (it connects when Connect() is called).
+        :int number: Bot number, for the log
+        :tuple address: (host, port) of the server
+        :Stats stats: Where to record measurements
+        :argparse.Namespace options: Behaviour options (move_rate, fire_rate, restart_delay and late)
+        :dict tcp_map: asyncore map shared by the TCP bots
+        :bool udp: Connect over UDP instead of TCP
+        :return: None
+        """
+        self.number = number
+        self.address = address
+        self.stats = stats
+        self.options = options
+        self.udp = udp
+        self.connection = DatagramEndPoint() if udp else TCPEndPoint(address, map=tcp_map)
+        self.connect_time = None
+        self.connected = False
+        self.player = None  # Player ID (None until seated)
+        self.players = PLAYERS
+        self.ready = False
+        self.restart_time = None  # When to ask for a restart (None if not waiting to)
+        self.command_clock = FixedTimestep(COMMAND_RATE)  # Started again when connecting
+        self.frames_skipped = 0  # Command frames not sent because the bot was called too late
+        self.command_number = 0
+        self.unconfirmed = deque()  # (frame number, time sent) for each command frame the server hasn't confirmed
+        self.direction = [0, 0, 0]  # dx, dy and turn used while moving
+
+    def __repr__(self):
+        return "Bot " + str(self.number)
+
+    def Connect(self):
+        """
+        Start connecting to the server.
+        :return: None
+        """
+        self.connect_time = time()
+        self.command_clock = FixedTimestep(COMMAND_RATE)
+        self.connection.DoConnect(self.address)
+
+    def Pump(self):
+        """
+        Hand each message received from the server to the matching Network_<action> callback and Network().
+        :return: None
+        """
+        for data in self.connection.GetQueue():
+            for name in ("Network_" + data['action'], "Network"):
+                if hasattr(self, name):
+                    getattr(self, name)(data)
+        if not self.udp:
+            self.connection.queue = list()  # The shared poll fills it again
+
+    def flush(self):
+        """
+        Send everything queued. Over TCP, the data arrives during the shared poll.
+        :return: None
+        """
+        if self.udp:
+            self.connection.Pump()
+        else:
+            Channel.Pump(self.connection)
+
+    def send(self, data, stream=None):
+        """
+        Send a message to the server, packed if it has a packed form.
+        :dict data: Message to send
+        :int stream: Stream the message belongs to if a newer message can replace it (only used over UDP)
+        :return: None
+        """
+        if wire.binary and wire.is_packable(data):
+            data = wire.pack(data)
+        if self.udp:
+            self.connection.Send(data, stream)
+        else:
+            self.connection.Send(data)
+
+    def act(self, now):
+        """
+        Do whatever the bot does at this point: send a command frame if one is due, and ask for a restart when it's
+        time to.
+        :float now: Current time
+        :return: None
+        """
+        if self.restart_time is not None and now >= self.restart_time:
+            self.restart_time = None
+            self.send({"action": "restart"})
+        steps = self.command_clock.due()
+        if steps:
+            self.frames_skipped += steps - 1
+            self.send_command(now)
+        while self.unconfirmed and now - self.unconfirmed[0][1] > DROPPED_FRAME:
+            self.unconfirmed.popleft()
+            self.stats.frames_dropped += 1
+
+    def send_command(self, now):
+        """
+        Move and fire at random (at the configured rates) with a command frame.
+        :float now: Current time
+        :return: None
+        """
+        if not self.ready:
+            return
+        buttons = FIRE if random.random() < float(self.options.fire_rate) / COMMAND_RATE else 0
+        move = [0, 0, 0]
+        if random.random() < float(self.options.move_rate) / COMMAND_RATE:
+            if random.random() < TURN_CHANCE or not any(self.direction):
+                self.direction = [random.choice((-MOVE_STEP, 0, MOVE_STEP)), random.choice((-MOVE_STEP, 0, MOVE_STEP)),
+                                  random.choice((-1, 0, 1))]
+            move = self.direction
+        if not (buttons or any(move)):
+            return
+        self.command_number += 1
+        self.unconfirmed.append((self.command_number, now))
+        self.stats.frames_sent += 1
+        data = {"action": "cmd", "n": self.command_number, "m": move, "b": buttons}
+        self.send(data, wire.stream(data))
+
+    def place(self):
+        """
+        Place the ship at the start position for its seat, like the client does when it joins or restarts.
+        :return: None
+        """
+        loc = list(start_position(player_slot(self.player), self.players))
+        self.send({"action": "move", "p": self.player, "p_pos": loc})
+
+    ###############################
+    ### Network event callbacks ###
+    ###############################
+
+    def Network(self, data):
+        self.stats.messages += 1
+
+    def Network_bin(self, data):
+        message = wire.unpack(data)
+        getattr(self, "Network_" + message["action"], lambda message: None)(message)
+
+    def Network_connected(self, data):
+        self.connected = True
+        self.stats.connect_times.append(time() - self.connect_time)
+
+    def Network_init(self, data):
+        if data["p"] == "full":
+            return  # Queued for a seat
+        if self.player is None:
+            self.stats.seat_times.append(time() - self.connect_time)
+        self.player = data["p"]
+        self.players = data.get("players", PLAYERS)
+        self.place()
+
+    def Network_ready(self, data):
+        self.ready = True
+
+    def Network_player_left(self, data):
+        if self.players == 2:
+            self.ready = False
+
+    def Network_game_over(self, data):
+        self.ready = False
+        self.restart_time = time() + self.options.restart_delay
+
+    def Network_restart(self, data):
+        self.restart_time = None
+        self.ready = True
+        self.place()
+
+    def Network_state(self, data):
+        """
+        Called when the server confirms the command frames it has applied, which gives their round-trip times.
+        :dict data: Network data from server
+        :return: None
+        """
+        now = time()
+        while self.unconfirmed and self.unconfirmed[0][0] <= data['n']:
+            number, sent = self.unconfirmed.popleft()
+            self.stats.round_trips.append(now - sent)
+            if (now - sent) * 1000 > self.options.late:
+                self.stats.frames_late += 1
+
+    def Network_delta(self, data):
+        self.send({"action": "ack", "s": data['s']}, wire.SNAPSHOT_STREAM)
+
+    def Network_error(self, data):
+        self.stats.errors += 1
+        sys.stderr.write(str(self) + ": " + str(data.get('error')) + "\n")
+        self.connected = False
+
+    def Network_disconnected(self, data):
+        self.stats.disconnects += 1
+        self.connected = False
+
+
+class Swarm(object):
+    """
+    Runs many bots from one process.
+    """
+    def __init__(self, address, bots, options, udp=False):
+        """
+        Create the bots.
+        :tuple address: (host, port) of the server
+        :int bots: Number of bots
+        :argparse.Namespace options: Behaviour options passed to each bot, plus connect_rate (bots connected per second)
+        :bool udp: Connect over UDP instead of TCP
+        :return: None
+        """
+        self.options = options
+        self.stats = Stats()
+        self.tcp_map = dict()
+        self.bots = [Bot(number + 1, address, self.stats, options, self.tcp_map, udp) for number in xrange(bots)]
+        self.active = list()  # Bots that have started connecting
+
+    def run(self, duration):
+        """
+        Connect the bots (at the configured rate) and run them.
+        :float duration: Seconds to run for
+        :return: None
+        """
+        start = last_report = time()
+        waiting = deque(self.bots)
+        while True:
+            now = time()
+            if now - start >= duration:
+                break
+            while waiting and (now - start) * self.options.connect_rate >= len(self.active):
+                bot = waiting.popleft()
+                bot.Connect()
+                self.active.append(bot)
+            for bot in self.active:
+                bot.Pump()
+                bot.act(now)
+                bot.flush()
+            self.stats.passes.append(time() - now)
+            if self.tcp_map:
+                asyncore.poll2(POLL_TIMEOUT, self.tcp_map)
+            else:
+                sleep(POLL_TIMEOUT)
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                print self.progress(now - start)
+                sys.stdout.flush()
+
+    def progress(self, elapsed):
+        """
+        One line summary of how the run is going.
+        :float elapsed: Seconds since the run started
+        :return: str
+        """
+        round_trips = self.stats.round_trips
+        return "%.0fs: %d connected, %d seated, %d frames sent, round trip p50 %s ms p99 %s ms, %d late, %d dropped" % (
+            elapsed, sum(1 for bot in self.active if bot.connected),
+            sum(1 for bot in self.active if bot.player is not None), self.stats.frames_sent,
+            "%.1f" % (percentile(round_trips, 50) * 1000) if round_trips else "-",
+            "%.1f" % (percentile(round_trips, 99) * 1000) if round_trips else "-",
+            self.stats.frames_late, self.stats.frames_dropped)
+
+    def report(self):
+        """
+        Results of the run.
+        :return: dict
+        """
+        stats = self.stats
+        return {"bots": len(self.bots),
+                "connected": sum(1 for bot in self.bots if bot.connected),
+                "seated": sum(1 for bot in self.bots if bot.player is not None),
+                "connect_ms": summarize(stats.connect_times),
+                "seat_ms": summarize(stats.seat_times),
+                "round_trip_ms": summarize(stats.round_trips),
+                "frames_sent": stats.frames_sent,
+                "frames_late": stats.frames_late,
+                "frames_dropped": stats.frames_dropped,
+                "frames_unconfirmed": sum(len(bot.unconfirmed) for bot in self.bots),
+                "frames_skipped": sum(bot.frames_skipped + bot.command_clock.dropped for bot in self.bots),
+                "pass_ms": summarize(stats.passes),
+                "messages_received": stats.messages,
+                "errors": stats.errors,
+                "disconnects": stats.disconnects}
+
+
+def print_report(report):
+    """
+    Print the results of a run for people to read.
+    :dict report: Results from Swarm.report()
+    :return: None
+    """
+    print str(report["connected"]) + " of " + str(report["bots"]) + " bots connected, " + str(report["seated"]) \
+        + " seated, " + str(report["errors"]) + " errors, " + str(report["disconnects"]) + " disconnected"
+    for name, label in (("connect_ms", "Connect"), ("seat_ms", "Seated"), ("round_trip_ms", "Round trip"),
+                        ("pass_ms", "Bot pass")):
+        summary = report[name]
+        if summary["count"]:
+            print "%-11s mean %8.1f ms, " % (label, summary["mean"]) \
+                + ", ".join("p" + str(p) + " %.1f ms" % summary["p" + str(p)] for p in PERCENTILES) \
+                + ", max %.1f ms" % summary["max"]
+    print "Command frames: " + str(report["frames_sent"]) + " sent, " + str(report["frames_late"]) + " late, " \
+        + str(report["frames_dropped"]) + " dropped, " + str(report["frames_unconfirmed"]) \
+        + " unconfirmed at the end, " + str(report["frames_skipped"]) + " skipped by the bots"
+    print "Messages received: " + str(report["messages_received"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiny Space Battles load generator (headless bots)")
+    parser.add_argument("address", help="host:port of the server, e.g. localhost:31425")
+    parser.add_argument("--bots", type=int, default=100, help="number of bots")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run for")
+    parser.add_argument("--connect-rate", type=float, default=50, help="bots connected per second")
+    parser.add_argument("--move-rate", type=float, default=MOVE_RATE,
+                        help="command frames a second in which each bot moves (at most " + str(COMMAND_RATE) + ")")
+    parser.add_argument("--fire-rate", type=float, default=FIRE_RATE, help="shots a second fired by each bot")
+    parser.add_argument("--restart-delay", type=float, default=RESTART_DELAY,
+                        help="seconds a bot waits after a battle is over before asking for a restart")
+    parser.add_argument("--late", type=float, default=LATE_FRAME_MS,
+                        help="round trip in milliseconds past which a command frame counts as late")
+    parser.add_argument("--udp", action="store_true", help="connect over UDP (the server must be started with --udp)")
+    parser.add_argument("--dict-wire", action="store_true", help="send move and cmd messages as plain dicts")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON to PATH")
+    args = parser.parse_args()
+    wire.binary = not args.dict_wire
+
+    raise_fd_limit()
+    host, port = args.address.split(":")
+    swarm = Swarm((host, int(port)), args.bots, args, args.udp)
+    try:
+        swarm.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    report = swarm.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
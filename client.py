@@ -1,55 +1,275 @@
 import sys
-from time import sleep
-from PodSixNet.Connection import connection, ConnectionListener
+import argparse
+import wire
+from time import sleep, time
+from collections import deque
+from PodSixNet.Connection import connection
+from datagram import EndPoint
+from scheduler import FixedTimestep
 from tinySpaceBattles import TinySpaceBattles
+from simulation import PLAYERS, MOVE_STEP, FIRE, SHIELD, trajectory_locs, player_slot, move_ship
 
+# Number of bullet snapshots kept as possible delta baselines
+SNAPSHOT_HISTORY = 120
 
-class Client(ConnectionListener, TinySpaceBattles):
+# How far (in ticks) the estimated server tick may run ahead of the ticks the server reports before resyncing
+MAX_TICK_DRIFT = 3
+
+# Client ticks per second. Input is collected into one command frame per tick.
+COMMAND_RATE = 60
+
+# Frames drawn per second by default
+FRAME_RATE = 60
+
+# How far (in seconds) behind the latest updates other ships and bullets are drawn, so there's an update either side
+# of the time being drawn to interpolate between as long as updates arrive at least this often
+INTERPOLATION_DELAY = 0.1
+
+
+def is_player(name):
+    """
+    Check if a name from the server is a player ID.
+    :str name: Name to check
+    :return: True for "p1", "p2", ...
+    """
+    return name[:1] == 'p' and name[1:].isdigit()
+
+
+class PositionBuffer(object):
+    """
+    Recent positions of another player's ship, stamped with the time they arrived, so the ship can be drawn at a time
+    slightly in the past part way between the positions either side of it.
+    """
+    def __init__(self, step, max_gap=INTERPOLATION_DELAY):
+        """
+        Set up an empty buffer.
+        :float step: Shortest time between positions (one server tick)
+        :float max_gap: Longest time between positions while the ship is moving
+        :return: None
+        """
+        self.step = step
+        self.max_gap = max_gap
+        self.positions = deque()  # (arrival time, [x, y, angle]) pairs, oldest first
+
+    def add(self, loc, now):
+        """
+        Store a newly arrived position.
+        :list loc: Ship location [x, y, angle]
+        :float now: Time it arrived
+        :return: None
+        """
+        if self.positions:
+            last_time, last_loc = self.positions[-1]
+            if now <= last_time:
+                # Arrived together with the last one, so only the newest is worth keeping
+                self.positions[-1] = (last_time, loc)
+                return
+            if now - last_time > self.max_gap:
+                # The ship has been still, so it starts moving from where it was just before this position arrived
+                self.positions.append((now - self.step, last_loc))
+        self.positions.append((now, loc))
+
+    def at(self, when):
+        """
+        Work out where the ship was at a given time, dropping positions that are no longer needed. Before the first
+        position or after the last one the ship is held where it was.
+        :float when: Time to work out the position for
+        :return: Ship location [x, y, angle]
+        """
+        positions = self.positions
+        while len(positions) > 1 and positions[1][0] <= when:
+            positions.popleft()
+        start_time, start = positions[0]
+        if len(positions) == 1 or when <= start_time:
+            return start
+        end_time, end = positions[1]
+        fraction = (when - start_time) / (end_time - start_time)
+        turn = (end[2] - start[2] + 180) % 360 - 180  # The short way round
+        return [int(round(start[0] + (end[0] - start[0]) * fraction)),
+                int(round(start[1] + (end[1] - start[1]) * fraction)),
+                int(round(start[2] + turn * fraction))]
+
+
+class Client(TinySpaceBattles):
     """
     The main client class.
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, dirty_rects=False, udp=False, fps=FRAME_RATE):
         """
         Initialize client: connect to server and init base game class.
         :str host: Server IP
         :int port: Server port
+        :bool dirty_rects: Redraw only the parts of the screen that change each frame
+        :bool udp: Connect over UDP instead of TCP
+        :int fps: Frames drawn per second
         :return: None
         """
+        self.udp = udp
+        self.connection = EndPoint() if udp else connection
         self.Connect((host, port))
         self.ready = False
-        TinySpaceBattles.__init__(self)
+        self.tick_rate = None
+        self.bullet_speed = None
+        self.snapshots = dict()  # Snapshot ID -> (bullet records keyed by ID, (P1 health, P2 health))
+        self.snapshot_id = None  # Latest snapshot applied
+        self.bullet_records = None  # Bullets simulated locally, keyed by ID (None if the server sends locations)
+        self.tick_anchor = None  # (server tick, local time) pair used to estimate the server's tick
+        self.command_clock = FixedTimestep(COMMAND_RATE)
+        self.command_number = 0  # Number of the last command frame sent
+        self.command_acked = 0  # Number of the last command frame the server has applied
+        self.command_move = [0.0, 0.0]  # Distance moved since the last frame, including fractions not sent yet
+        self.command_turn = 0  # Rotation steps since the last frame
+        self.command_buttons = 0  # Buttons pressed since the last frame
+        self.frame_clock = FixedTimestep(fps, max_catchup=1)
+        self.remote_positions = dict()  # Player ID -> PositionBuffer, for every other player
+        TinySpaceBattles.__init__(self, dirty_rects)
 
     def loop(self):
         """
-        Main game loop for client.
+        Main game loop for client. Network traffic and events are handled every time round, but the Wiimote is only
+        read once per command frame (so the ship moves at the same speed however fast the loop runs) and frames are only
+        drawn at the frame rate.
         :return: None
         """
         self.Pump()
-        connection.Pump()
+        self.connection.Pump()
         self.events()
-        self.check_for_wiimote_move()
+        if self.command_clock.due():
+            self.check_for_wiimote_move()
+            self.send_command()
+        if self.frame_clock.due():
+            self.render()
+
+    def wait(self):
+        """
+        Sleep until the next command frame or drawn frame is due.
+        :return: None
+        """
+        sleep(min(self.command_clock.time_left(), self.frame_clock.time_left()))
+
+    def render(self):
+        """
+        Draw a frame. Other players' ships and the bullets are drawn INTERPOLATION_DELAY behind the latest updates,
+        between the updates either side, so they move smoothly even when updates arrive less often than frames are
+        drawn. The player's own ship is drawn where it is now.
+        :return: None
+        """
+        when = time() - INTERPOLATION_DELAY
+        for player, positions in self.remote_positions.iteritems():
+            if player in self.ships:
+                self.ships[player].update(positions.at(when))
+        if self.bullet_records is not None and self.tick_anchor is not None:
+            tick = self.server_tick() - INTERPOLATION_DELAY * self.tick_rate
+            fired = dict((bullet_id, record) for bullet_id, record in self.bullet_records.iteritems()
+                         if record[0] <= tick)
+            self.update_bullets(trajectory_locs(fired, tick, self.bullet_speed))
         self.draw()
+        self.frame += 1
 
         if "Connecting" in self.statusLabel:
             self.statusLabel = "Connecting" + ("." * ((self.frame / 30) % 4))
 
+    def Connect(self, address):
+        """
+        Connect to the server.
+        :tuple address: (host, port) of the server
+        :return: None
+        """
+        self.connection.DoConnect(address)
+        self.Pump()  # Check for connection errors
+
+    def Pump(self):
+        """
+        Hand each message received from the server to the matching Network_<action> callback and Network().
+        :return: None
+        """
+        for data in self.connection.GetQueue():
+            for name in ("Network_" + data['action'], "Network"):
+                if hasattr(self, name):
+                    getattr(self, name)(data)
+
+    def send(self, data, stream=None):
+        """
+        Send a message to the server.
+        :dict data: Message to send
+        :int stream: Stream the message belongs to if a newer message can replace it (only used over UDP)
+        :return: None
+        """
+        if self.udp:
+            self.connection.Send(data, stream)
+        else:
+            self.connection.Send(data)
+
+    def server_tick(self):
+        """
+        Estimate the server's current tick.
+        :return: Tick number (fractional between ticks)
+        """
+        tick, anchor_time = self.tick_anchor
+        return tick + (time() - anchor_time) * self.tick_rate
+
+    def sync_tick(self, tick):
+        """
+        Update the server tick estimate from a tick reported by the server. The estimate only moves back if it has
+        run well ahead (e.g. while the server was paused), so network jitter doesn't make bullets jump backwards.
+        :int tick: Tick reported by the server
+        :return: None
+        """
+        if self.tick_anchor is None or tick > self.server_tick() or self.server_tick() - tick > MAX_TICK_DRIFT:
+            self.tick_anchor = (tick, time())
+
     def send_action(self, action):
         """
-        Send player data to server.
+        Send player data to server. This is sent reliably even over UDP, as a move sent this way places the ship (when
+        the player joins or restarts) and the command frames that follow are applied from there.
         :str action: A string containing the action to perform.
         :return: None
         """
-        if self.is_p1 is None:
+        if self.player is None:
             return
-        if self.is_p1:
-            player = self.p1
-        else:
-            player = self.p2
+        player = self.ship(self.player)
         loc = player.rect_xy
         loc.append(player.angle)
 
+        if action == 'move':
+            # The ship is placed afresh, so moves sent before no longer apply
+            player.position_hist.clear()
+            self.command_acked = self.command_number
+
         # Send to server
-        connection.Send({"action": action, "p": self.which_player(), "p_pos": loc})
+        data = {"action": action, "p": self.which_player(), "p_pos": loc}
+        if wire.binary and wire.is_packable(data):
+            data = wire.pack(data)
+        self.send(data)
+
+    def send_command(self):
+        """
+        Apply the input collected this tick to the player's ship and send it to the server as a command frame, which
+        the server applies in the same way. The move is kept until the server confirms it. Nothing is sent for a tick
+        without input.
+        :return: None
+        """
+        if self.player is None:
+            return
+        dx, dy = [int(round(distance)) for distance in self.command_move]
+        turn, buttons = self.command_turn, self.command_buttons
+        self.command_move = [self.command_move[0] - dx, self.command_move[1] - dy]
+        self.command_turn = self.command_buttons = 0
+        if not (dx or dy or turn or buttons):
+            return
+
+        self.command_number += 1
+        if dx or dy or turn:
+            player = self.ship(self.player)
+            loc = list(move_ship((player.rect.x, player.rect.y, player.angle), player_slot(self.player), dx, dy, turn))
+            player.update(loc)
+            player.position_hist.append((self.command_number, [dx, dy, turn]))
+
+        data = {"action": "cmd", "n": self.command_number, "m": [dx, dy, turn], "b": buttons}
+        stream = wire.stream(data)
+        if wire.binary:
+            data = wire.pack(data)
+        self.send(data, stream)
 
     #######################
     ### Event callbacks ###
@@ -57,41 +277,28 @@ class Client(ConnectionListener, TinySpaceBattles):
 
     def player_move(self, direction, x_mag=1, y_mag=1):
         """
-        Moves the player.
+        Moves the player (at the end of the tick, along with any other input).
         :param direction: Up, down, left, right
         :param x_mag: Magnitude of x (between 0 and 1 for Nunchuck joystick) for joystick sensitivity
         :param y_mag: Magnitude of y (between 0 and 1 for Nunchuck joystick) for joystick sensitivity
         :return: None
         """
-        if self.is_p1 is None:
+        if self.player is None:
             return
-        if self.is_p1:
-            player = self.p1
-        else:
-            player = self.p2
-
-        loc = player.rect_xy
 
         if 'l' in direction:
-            loc[0] -= 8*x_mag
+            self.command_move[0] -= MOVE_STEP*x_mag
         if 'r' in direction:
-            loc[0] += 8*x_mag
+            self.command_move[0] += MOVE_STEP*x_mag
         if 'u' in direction:
-            loc[1] -= 8*y_mag
+            self.command_move[1] -= MOVE_STEP*y_mag
         if 'd' in direction:
-            loc[1] += 8*y_mag
+            self.command_move[1] += MOVE_STEP*y_mag
 
         if 'ccw' in direction:
-            loc.append((player.angle + 5) % 360)
+            self.command_turn += 1
         elif 'cw' in direction:
-            loc.append((player.angle - 5) % 360)
-        else:
-            loc.append(player.angle)
-
-        # Push to player position list and notify server
-        player.update(loc, True)
-        player.position_hist.append(loc)
-        self.send_action('move')
+            self.command_turn -= 1
 
     def player_restart(self):
         """
@@ -106,7 +313,7 @@ class Client(ConnectionListener, TinySpaceBattles):
         :return: None
         """
         if self.ready:
-            self.send_action('fire')
+            self.command_buttons |= FIRE
 
     def player_shield(self):
         """
@@ -114,26 +321,40 @@ class Client(ConnectionListener, TinySpaceBattles):
         :return: None
         """
         if self.ready:
-            self.send_action('shield')
+            self.command_buttons |= SHIELD
 
     ###############################
     ### Network event callbacks ###
     ###############################
 
+    def Network_bin(self, data):
+        """
+        Called when packed data is received. Unpacks it and hands it to the matching callback, if there is one.
+        :dict data: Network data from server
+        :return: None
+        """
+        message = wire.unpack(data)
+        getattr(self, "Network_" + message["action"], lambda message: None)(message)
+
     def Network_init(self, data):
         """
         Called when network init data is received by PodSixNet. Performs client setup.
         :dict data: Network data from server
         :return: None
         """
+        if "tick_rate" in data:
+            self.tick_rate = data["tick_rate"]
+            self.bullet_speed = data["bullet_speed"]
+        self.remote_positions = dict()
         if data["p"] == 'p1':
-            self.is_p1 = True
+            self.join(data["p"], data.get("players", PLAYERS))
             print("No other players currently connected. You are P1.")
+            self.playersLabel = "Waiting for player"
             # Send position to server
             self.send_action('move')
-        elif data["p"] == 'p2':
-            self.is_p1 = False
-            print('You are P2. The game will start momentarily.')
+        elif is_player(data["p"]):
+            self.join(data["p"], data.get("players", PLAYERS))
+            print('You are ' + data["p"].upper() + '. The game will start momentarily.')
             # Send position to server
             self.send_action('move')
         elif data["p"] == 'full':
@@ -160,8 +381,16 @@ class Client(ConnectionListener, TinySpaceBattles):
         :dict data: Network data from server
         :return: None
         """
-        self.playersLabel = "Other player left server"
-        self.ready = False
+        player = data.get("p")
+        if player != self.player:
+            self.ships.pop(player, None)
+            self.remote_positions.pop(player, None)
+        if self.players == 2:
+            self.playersLabel = "Other player left server"
+        else:
+            self.playersLabel = str(player).upper() + " left server"
+        if len(self.ships) < 2:
+            self.ready = False
 
     def Network_move(self, data):
         """
@@ -171,18 +400,42 @@ class Client(ConnectionListener, TinySpaceBattles):
         """
         position = data['p_pos']
         player = data['p']
-        if player == 'p1' and not self.is_p1:
-            self.p1.update(position)
-        elif player == 'p2' and self.is_p1:
-            self.p2.update(position)
-        elif player in ('p1', 'p2'):  # This is client's position coming back from player
+        if player == self.player:  # This is client's position coming back from player
             pass  # TODO: Anti-cheat detection here
+        elif is_player(player):
+            positions = self.remote_positions.get(player)
+            if positions is None:
+                # First position since joining or restarting, so place the ship there rather than gliding to it
+                positions = self.remote_positions[player] = PositionBuffer(1.0 / (self.tick_rate or COMMAND_RATE))
+                self.ship(player).update(position)
+            positions.add(position, time())
         else:
             sys.stderr.write("ERROR: Couldn't update player movement information.\n")
             sys.stderr.write(str(data) + "\n")
             sys.stderr.flush()
             sys.exit(1)
 
+    def Network_state(self, data):
+        """
+        Called when the server reports where the player's ship is after the last command frame it applied. The moves
+        sent since are replayed on top of it, so the ship stays where it's predicted to be unless the server disagrees
+        (e.g. a command frame was lost).
+        :dict data: Network data from server
+        :return: None
+        """
+        if self.player is None or data['n'] <= self.command_acked:
+            return  # Stale, or from before the ship was last placed
+        self.command_acked = data['n']
+        player = self.ship(self.player)
+        history = player.position_hist
+        while history and history[0][0] <= data['n']:
+            history.popleft()
+        loc = data['p_pos']
+        slot = player_slot(self.player)
+        for number, (dx, dy, turn) in history:
+            loc = move_ship(loc, slot, dx, dy, turn)
+        player.update(list(loc))
+
     def Network_bullets(self, data):
         """
         Called when bulled data is received from server.
@@ -190,16 +443,95 @@ class Client(ConnectionListener, TinySpaceBattles):
         :return: None
         """
         self.update_bullets(data['bullets'])
-        self.p1.health = data['p1_health']
-        self.p2.health = data['p2_health']
+        self.set_health(data['health'])
+
+    def Network_delta(self, data):
+        """
+        Called when a bullet snapshot delta is received from server. Applies it to the baseline snapshot it was made
+        against and acknowledges it.
+        :dict data: Network data from server
+        :return: None
+        """
+        snapshot_id = data['s']
+        if self.snapshot_id is not None and snapshot_id <= self.snapshot_id:
+            return  # Stale
+        if data['b'] == -1:
+            bullets, health = dict(), None
+        elif data['b'] in self.snapshots:
+            bullets, health = self.snapshots[data['b']]
+            bullets = dict(bullets)
+        else:
+            return  # Baseline no longer held; the server will fall back to a full snapshot
+        for bullet_id in data['despawn']:
+            bullets.pop(bullet_id, None)
+        for bullet_id, spawn_tick, x, y, angle in data['spawn']:
+            bullets[bullet_id] = (spawn_tick, x, y, angle)
+        if 'health' in data:
+            health = tuple(data['health'])
+
+        # Store the snapshot, dropping ones too old to be used as a baseline
+        self.snapshots[snapshot_id] = (bullets, health)
+        for old_id in [old_id for old_id in self.snapshots if old_id <= snapshot_id - SNAPSHOT_HISTORY]:
+            del self.snapshots[old_id]
+        self.snapshot_id = snapshot_id
+        self.bullet_records = bullets
+        self.sync_tick(snapshot_id)
+
+        self.set_health(health)
+        self.send({"action": "ack", "s": snapshot_id}, wire.SNAPSHOT_STREAM)
+
+    def Network_spawn(self, data):
+        """
+        Called when bullets are fired. The client simulates them until it's told they've been removed.
+        :dict data: Network data from server
+        :return: None
+        """
+        if self.bullet_records is None:
+            self.bullet_records = dict()
+        for bullet_id, spawn_tick, x, y, angle in data['b']:
+            self.bullet_records[bullet_id] = (spawn_tick, x, y, angle)
+            self.sync_tick(spawn_tick)
+        self.update_health(data)
+
+    def Network_despawn(self, data):
+        """
+        Called when bullets have hit a player or left the screen.
+        :dict data: Network data from server
+        :return: None
+        """
+        if self.bullet_records is not None:
+            for bullet_id in data['ids']:
+                self.bullet_records.pop(bullet_id, None)
+        self.update_health(data)
+
+    def update_health(self, data):
+        """
+        Update the players' health from network data, if it's included.
+        :dict data: Network data from server
+        :return: None
+        """
+        if data.get('health') is not None:
+            self.set_health(data['health'])
 
     def Network_death(self, data):
         """
-        Called when player death is received from server.
+        Called when player death is received from server. The battle carries on until game over.
         :dict data: Network data from server
         :return: None
         """
-        self.win_or_lose(data['p'])
+        if data.get('killer') == self.player:
+            self.kills += 1
+        if data['p'] == self.player and self.players > 2:
+            self.playersLabel = "Destroyed by " + str(data.get('killer')).upper()
+
+    def Network_game_over(self, data):
+        """
+        Called when the battle is over, i.e. no more than one player is left.
+        :dict data: Network data from server
+        :return: None
+        """
+        self.kills = data['scores'].get(self.player, self.kills)
+        self.win_or_lose(data['winner'])
         self.ready = False
 
     def Network_restart(self, data):
@@ -209,11 +541,11 @@ class Client(ConnectionListener, TinySpaceBattles):
         :return: None
         """
         # Reset position and send to server
-        if self.is_p1:
-            self.p1.rand_pos(True)
-        else:
-            self.p2.rand_pos(False)
+        if self.player is None:
+            return
+        self.ship(self.player).rand_pos(player_slot(self.player), self.players)
         self.send_action('move')
+        self.remote_positions = dict()  # Everyone is placed afresh
 
         # Clear game over flag
         self.game_over = False
@@ -252,7 +584,7 @@ class Client(ConnectionListener, TinySpaceBattles):
         import traceback
         traceback.print_exc()
         self.statusLabel = data['error'][1]
-        connection.Close()
+        self.connection.Close()
 
     def Network_disconnected(self, data):
         """
@@ -264,12 +596,19 @@ class Client(ConnectionListener, TinySpaceBattles):
         self.playersLabel = "No other players"
         self.ready = False
 
-if len(sys.argv) != 2:
-    print "Usage:", sys.argv[0], "host:port"
-    print "e.g.", sys.argv[0], "localhost:31425"
-else:
-    host, port = sys.argv[1].split(":")
-    c = Client(host, int(port))
-    while 1:
-        c.loop()
-        sleep(0.001)
+parser = argparse.ArgumentParser(description="Tiny Space Battles client")
+parser.add_argument("address", help="host:port of the server, e.g. localhost:31425")
+parser.add_argument("--dict-wire", action="store_true", help="send move messages as plain dicts")
+parser.add_argument("--udp", action="store_true", help="connect over UDP (the server must be started with --udp)")
+parser.add_argument("--dirty-rects", action="store_true",
+                    help="redraw only the parts of the screen that change (lower CPU use on slow machines)")
+parser.add_argument("--fps", type=int, default=FRAME_RATE,
+                    help="frames drawn per second (default: " + str(FRAME_RATE) + ")")
+args = parser.parse_args()
+wire.binary = not args.dict_wire
+
+host, port = args.address.split(":")
+c = Client(host, int(port), args.dirty_rects, args.udp, args.fps)
+while 1:
+    c.loop()
+    c.wait()
@@ -0,0 +1,539 @@
+"""
+UDP transport, an alternative to the TCP transport for lossy networks.
+
+Over TCP a lost packet holds up everything sent after it until it has been resent, even though the move and bullet
+updates behind it are newer than what it carries. Here each message is either:
+
+* Unreliable: move and bullet updates (see wire.stream()). They're sent once, and a message is dropped if a newer one
+  on the same stream has already arrived.
+* Reliable: everything else (init, ready, death, restart, player_left, ...). These are resent until they're
+  acknowledged and delivered in order, split over several packets if they're too big for one.
+
+A few reliable messages are barriers (see wire.is_barrier()): unreliable messages are never delivered ahead of a
+barrier sent before them, so e.g. a client doesn't see moves for a match it hasn't been told it's in. Other reliable
+messages don't hold them up, so a lost one doesn't stall move and bullet updates while it's resent. Messages are
+encoded exactly as for TCP and dispatched to the same Network_<action> callbacks.
+
+Before anything is set up for a client, it has to prove it can receive packets at the address it's sending from, so a
+forged source address can't take a seat or have the server send packets to someone else. The client sends HELLO and
+the server replies with CHALLENGE, holding a cookie worked out from the client's address and the time, so the server
+remembers nothing. The client echoes the cookie in RESPONSE, and only then does the server create a channel. Each of
+these packets is the same size, so a reply is never bigger than what prompted it.
+"""
+import os
+import sys
+import hmac
+import errno
+import struct
+import socket
+import hashlib
+import traceback
+from time import time
+from collections import deque
+from PodSixNet.rencode import loads, dumps
+from transport import Channel, TERMINATOR, WOULD_BLOCK
+
+# Packet kinds
+DATA = 0
+CLOSE = 1
+HELLO = 2  # Client asking to connect
+CHALLENGE = 3  # Server's reply to HELLO, holding a cookie for the client's address
+RESPONSE = 4  # Client echoing the cookie, after which the server accepts the connection
+
+PACKET = struct.Struct("!BIIIHH")  # Kind, sequence, ack, last barrier sent, reliable count, unreliable count
+RELIABLE = struct.Struct("!IBH")  # Sequence, more fragments follow, length
+UNRELIABLE = struct.Struct("!BH")  # Stream, length
+HANDSHAKE = struct.Struct("!B16s")  # Kind, cookie (zeros in HELLO)
+
+# Most bytes in a packet (chosen to fit in one Ethernet frame with room for the IP and UDP headers), and in a datagram
+# (messages bigger than a packet are only sent when they can't be split)
+MAX_PACKET = 1200
+MAX_DATAGRAM = 65507
+MAX_FRAGMENT = MAX_PACKET - PACKET.size - RELIABLE.size
+
+# Most reliable messages held out of order while waiting for an earlier one to be resent
+MAX_EARLY = 4096
+
+# Seconds before an unacknowledged reliable message is resent, between packets sent to keep an idle connection alive,
+# and of silence before the other end is assumed to have gone
+RESEND_INTERVAL = 0.1
+KEEPALIVE_INTERVAL = 0.5
+TIMEOUT = 10
+
+# Seconds in each cookie period (a cookie is accepted in the period it's given out in and the one after)
+COOKIE_PERIOD = 10
+
+
+class Link(object):
+    """
+    One end of a connection: sequences, acknowledges and resends messages, and works out which incoming messages to
+    deliver. Sockets are left to the caller.
+    """
+    def __init__(self, now):
+        self.sequence = 0  # Last packet sent
+        self.next_reliable = 1  # Sequence number for the next reliable message (or fragment)
+        self.barrier = 0  # Last fragment of the last barrier queued
+        self.unacked = deque()  # [sequence, more fragments follow, message, last sent] for each reliable message sent
+        self.unreliable = list()  # (stream, message) for each unreliable message waiting to be sent (None if replaced)
+        self.streams = dict()  # Stream -> index in unreliable of the last message queued on it
+        self.delivered = 0  # Last reliable message (or fragment) delivered
+        self.early = dict()  # Sequence -> (more fragments follow, message) for reliable messages received out of order
+        self.fragments = list()  # Fragments of the reliable message being delivered
+        self.latest = dict()  # Stream -> sequence of the packet holding the newest message delivered
+        self.ack_due = False  # True when reliable messages have arrived since the last packet sent
+        self.last_sent = 0
+        self.last_heard = now
+        self.heard = False  # True once anything has arrived
+        self.closed = False  # True once the other end has closed the connection
+
+    def queue(self, message, stream=None, barrier=False):
+        """
+        Queue an encoded message to send.
+        :str message: Encoded message (without the terminator)
+        :int stream: Stream the message replaces older messages on (None to send it reliably)
+        :bool barrier: True if unreliable messages queued after it must not be delivered before it (reliable only)
+        :return: None
+        """
+        if stream is not None:
+            # Drop the last message queued on the stream if it hasn't been sent yet
+            index = self.streams.get(stream)
+            if index is not None:
+                self.unreliable[index] = None
+            self.streams[stream] = len(self.unreliable)
+            self.unreliable.append((stream, message))
+            return
+        for start in xrange(0, max(len(message), 1), MAX_FRAGMENT):
+            more = start + MAX_FRAGMENT < len(message)
+            self.unacked.append([self.next_reliable, more, message[start:start + MAX_FRAGMENT], 0])
+            self.next_reliable += 1
+        if barrier:
+            self.barrier = self.next_reliable - 1
+
+    def is_due(self, now):
+        """
+        Check if there's anything to send, including resends, acknowledgements and keepalives.
+        :float now: Current time
+        :return: True if packets() would return anything
+        """
+        keepalive = KEEPALIVE_INTERVAL if self.heard else RESEND_INTERVAL
+        return bool(self.unreliable) or self.ack_due or now - self.last_sent >= keepalive \
+            or bool(self.unacked) and now - self.unacked[0][3] >= RESEND_INTERVAL
+
+    def packets(self, now):
+        """
+        Build the packets to send now: unreliable messages queued since the last call, reliable messages that haven't
+        been sent or are due to be resent, and an empty packet if one is needed to acknowledge messages or keep the
+        connection alive.
+        :float now: Current time
+        :return: list of packets
+        """
+        if not self.is_due(now):
+            return list()
+        reliable = [entry for entry in self.unacked if now - entry[3] >= RESEND_INTERVAL]
+        for entry in reliable:
+            entry[3] = now
+        unreliable, self.unreliable = [entry for entry in self.unreliable if entry is not None], list()
+        self.streams = dict()
+
+        packets = list()
+        parts = list()
+        size = PACKET.size
+        counts = [0, 0]
+        for entry in reliable:
+            if size + RELIABLE.size + len(entry[2]) > MAX_PACKET and parts:
+                packets.append(self.packet(parts, counts))
+                parts, size, counts = list(), PACKET.size, [0, 0]
+            parts.append(RELIABLE.pack(entry[0], entry[1], len(entry[2])))
+            parts.append(entry[2])
+            size += RELIABLE.size + len(entry[2])
+            counts[0] += 1
+        for stream, message in unreliable:
+            if PACKET.size + UNRELIABLE.size + len(message) > MAX_DATAGRAM:
+                sys.stderr.write("warning: dropped a " + str(len(message)) + " byte message, too big for a datagram\n")
+                continue
+            if size + UNRELIABLE.size + len(message) > MAX_PACKET and parts:
+                packets.append(self.packet(parts, counts))
+                parts, size, counts = list(), PACKET.size, [0, 0]
+            parts.append(UNRELIABLE.pack(stream, len(message)))
+            parts.append(message)
+            size += UNRELIABLE.size + len(message)
+            counts[1] += 1
+        if parts or not packets:
+            packets.append(self.packet(parts, counts))
+        return packets
+
+    def packet(self, parts, counts):
+        """
+        Put a packet together.
+        :list parts: Headers and messages for the packet's contents
+        :list counts: Number of reliable and unreliable messages in the packet
+        :return: Packet
+        """
+        self.sequence += 1
+        self.ack_due = False
+        self.last_sent = time()
+        return PACKET.pack(DATA, self.sequence, self.delivered, self.barrier, counts[0], counts[1]) \
+            + "".join(parts)
+
+    def close_packet(self):
+        """
+        Build a packet telling the other end the connection is closing.
+        :return: Packet
+        """
+        self.sequence += 1
+        return PACKET.pack(CLOSE, self.sequence, self.delivered, self.barrier, 0, 0)
+
+    def receive(self, packet, now):
+        """
+        Take in a packet from the other end.
+        :str packet: Packet received
+        :float now: Current time
+        :return: list of encoded messages to deliver
+        """
+        try:
+            return self._receive(packet, now)
+        except struct.error:
+            raise ValueError("Malformed packet")
+
+    def _receive(self, packet, now):
+        kind, sequence, ack, barrier, reliable_count, unreliable_count = PACKET.unpack_from(packet)
+        self.last_heard = now
+        self.heard = True
+        if kind == CLOSE:
+            self.closed = True
+            return list()
+        while self.unacked and self.unacked[0][0] <= ack:
+            self.unacked.popleft()
+
+        offset = PACKET.size
+        messages = list()
+        for i in xrange(reliable_count):
+            reliable, more, length = RELIABLE.unpack_from(packet, offset)
+            offset += RELIABLE.size
+            if self.delivered < reliable <= self.delivered + MAX_EARLY:
+                self.early[reliable] = (more, packet[offset:offset + length])
+            offset += length
+            self.ack_due = True
+        while self.delivered + 1 in self.early:
+            self.delivered += 1
+            more, fragment = self.early.pop(self.delivered)
+            self.fragments.append(fragment)
+            if not more:
+                messages.append("".join(self.fragments))
+                self.fragments = list()
+
+        # Drop unreliable messages sent after a barrier that hasn't been delivered yet, as well as stale ones
+        for i in xrange(unreliable_count):
+            stream, length = UNRELIABLE.unpack_from(packet, offset)
+            offset += UNRELIABLE.size
+            if barrier <= self.delivered and sequence >= self.latest.get(stream, 0):
+                self.latest[stream] = sequence
+                messages.append(packet[offset:offset + length])
+            offset += length
+        return messages
+
+
+class DatagramChannel(Channel):
+    """
+    A client connected over UDP. Mix in before a Channel subclass to give it a UDP connection instead of TCP, e.g.
+    class DatagramServerChannel(DatagramChannel, ServerChannel). The channel's socket is the server's UDP socket,
+    shared with every other UDP client.
+    """
+    def __init__(self, conn, addr, server):
+        super(DatagramChannel, self).__init__(conn, addr, server)
+        self.link = Link(time())
+
+    def send_encoded(self, outgoing, stream=None, barrier=False):
+        """
+        Queue a message that has already been encoded.
+        :str outgoing: Message from encode()
+        :int stream: Stream the message replaces older messages on (None to send it reliably)
+        :bool barrier: True if unreliable messages sent after it must not be delivered before it
+        :return: Number of bytes queued
+        """
+        if self.closed:
+            return 0
+        self.link.queue(outgoing[:-len(TERMINATOR)], stream, barrier)
+        self._server.pending.add(self)
+        return len(outgoing)
+
+    def flush(self):
+        """
+        Send every packet that's due.
+        :return: None
+        """
+        if self.closed:
+            return
+        for packet in self.link.packets(time()):
+            try:
+                self.socket.sendto(packet, self.addr)
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK:
+                    sys.stderr.write("warning: sending to " + str(self.addr) + " failed: " + str(e) + "\n")
+
+    def receive(self, packet):
+        """
+        Handle a packet from the client.
+        :str packet: Packet received
+        :return: None
+        """
+        for message in self.link.receive(packet, time()):
+            if self.closed:
+                break
+            self.found_message(message)
+        if self.link.closed:
+            self.close()
+        elif self.link.ack_due:
+            self._server.pending.add(self)
+
+    def close(self):
+        """
+        Close the connection (if it isn't already) and call Close() if it's defined.
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if not self.link.closed:
+            try:
+                self.socket.sendto(self.link.close_packet(), self.addr)
+            except socket.error:
+                pass
+        self._server.channels.discard(self)
+        self._server.pending.discard(self)
+        self._server.datagrams.peers.pop(self.addr, None)
+        if hasattr(self, "Close"):
+            self.Close()
+
+
+class DatagramListener(object):
+    """
+    Accepts UDP clients for a Server, alongside its TCP clients, creating a channelClass for each one. The listener
+    becomes the server's datagrams attribute. Call service() regularly to resend lost messages, keep connections alive
+    and drop clients that have gone quiet.
+    """
+    def __init__(self, server, localaddr, channelClass):
+        """
+        Start listening.
+        :Server server: Server to add UDP clients to
+        :tuple localaddr: (host, port) to listen on
+        :type channelClass: DatagramChannel subclass to create for each client
+        :return: None
+        """
+        self.server = server
+        self.channelClass = channelClass
+        self.peers = dict()  # Client address -> channel
+        self.secret = os.urandom(16)  # Key for cookies
+        self.last_service = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(localaddr)
+        self.socket.setblocking(False)
+        server.reactor.register(self.socket.fileno(), self)
+        server.datagrams = self
+
+    def handle_read(self):
+        """
+        Handle every packet waiting, challenging new clients and creating channels for those that answer.
+        :return: None
+        """
+        while True:
+            try:
+                packet, addr = self.socket.recvfrom(MAX_DATAGRAM)
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK + (errno.ECONNREFUSED,):
+                    sys.stderr.write("warning: server recvfrom() failed: " + str(e) + "\n")
+                return
+            if not packet:
+                continue
+            channel = self.peers.get(addr)
+            if channel is None:
+                self.handshake(packet, addr)
+                continue
+            if ord(packet[0]) not in (DATA, CLOSE):
+                continue  # Handshake repeated before the client heard from its channel
+            try:
+                channel.receive(packet)
+            except ValueError:
+                sys.stderr.write("warning: bad packet from " + str(addr) + "\n")
+            except Exception:
+                # A failing handler only takes down its own client, as with a TCP channel's handle_error()
+                traceback.print_exc()
+                channel.close()
+
+    def cookie(self, addr, period):
+        """
+        Work out the cookie for a client address.
+        :tuple addr: Address of the client
+        :int period: Cookie period (see COOKIE_PERIOD)
+        :return: Cookie
+        """
+        digest = hmac.new(self.secret, addr[0] + ":" + str(addr[1]) + ":" + str(period), hashlib.sha256).digest()
+        return digest[:HANDSHAKE.size - 1]
+
+    def handshake(self, packet, addr):
+        """
+        Handle a packet from an address without a channel: create one if it's a RESPONSE with a valid cookie, or
+        otherwise answer a handshake with a CHALLENGE. Anything else is ignored.
+        :str packet: Packet received
+        :tuple addr: Address of the client
+        :return: None
+        """
+        if len(packet) != HANDSHAKE.size or ord(packet[0]) not in (HELLO, RESPONSE):
+            return
+        kind, cookie = HANDSHAKE.unpack(packet)
+        period = int(time() // COOKIE_PERIOD)
+        if kind == RESPONSE and (hmac.compare_digest(cookie, self.cookie(addr, period))
+                                 or hmac.compare_digest(cookie, self.cookie(addr, period - 1))):
+            channel = self.peers[addr] = self.channelClass(self.socket, addr, self.server)
+            self.server.add_channel(channel)
+            return
+        try:
+            self.socket.sendto(HANDSHAKE.pack(CHALLENGE, self.cookie(addr, period)), addr)
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                sys.stderr.write("warning: sending to " + str(addr) + " failed: " + str(e) + "\n")
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        traceback.print_exc()
+
+    def service(self):
+        """
+        Send resends and keepalives that are due, and drop clients that haven't been heard from in a while.
+        :return: None
+        """
+        now = time()
+        if now - self.last_service < RESEND_INTERVAL / 2:
+            return
+        self.last_service = now
+        for channel in self.peers.values():
+            if now - channel.link.last_heard > TIMEOUT:
+                print "Disconnecting " + str(channel.addr) + ": timed out"
+                channel.close()
+            elif channel.link.is_due(now):
+                channel.flush()
+
+
+class EndPoint(object):
+    """
+    The client end of a UDP connection, used in place of PodSixNet's EndPoint. Incoming messages are queued for the
+    caller to read with GetQueue().
+    """
+    def __init__(self):
+        self.socket = None
+        self.link = None
+        self.isConnected = False
+        self.queue = list()
+        self.cookie = None  # Cookie from the server's CHALLENGE (None until it arrives)
+        self.last_handshake = 0
+
+    def DoConnect(self, address):
+        """
+        Start connecting to a server. Messages sent are held back until the server has accepted the handshake.
+        :tuple address: (host, port) of the server
+        :return: None
+        """
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect(address)
+            self.socket.setblocking(False)
+        except socket.error as e:
+            self.queue.append({"action": "error", "error": e.args})
+            return
+        self.link = Link(time())
+        self.cookie = None
+        self.last_handshake = 0
+        self.Pump()
+
+    def GetQueue(self):
+        return self.queue
+
+    def Send(self, data, stream=None):
+        """
+        Queue a message to send. It's sent the next time the connection is pumped.
+        :dict data: Message to send
+        :int stream: Stream the message replaces older messages on (None to send it reliably)
+        :return: None
+        """
+        if self.link is not None:
+            self.link.queue(dumps(data), stream)
+
+    def Pump(self):
+        """
+        Clear the queue, then queue every message that has arrived and send everything that's due.
+        :return: None
+        """
+        self.queue = list()
+        if self.link is None:
+            return
+        now = time()
+        while True:
+            try:
+                packet = self.socket.recv(MAX_DATAGRAM)
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                self.queue.append({"action": "error", "error": e.args})
+                return
+            if len(packet) == HANDSHAKE.size and ord(packet[0]) == CHALLENGE:
+                if not self.link.heard:
+                    self.cookie = HANDSHAKE.unpack(packet)[1]
+                    self.last_handshake = 0  # Answer straight away
+                continue
+            try:
+                messages = self.link.receive(packet, now)
+            except ValueError:
+                continue
+            for message in messages:
+                data = loads(message)
+                if data.get("action") == "connected":
+                    self.isConnected = True
+                self.queue.append(data)
+            if self.link.closed:
+                self.Close()
+                return
+        if now - self.link.last_heard > TIMEOUT:
+            if self.isConnected:
+                self.Close()
+            else:
+                self.queue.append({"action": "error", "error": (errno.ETIMEDOUT, "Connection timed out")})
+                self.socket.close()
+                self.link = None
+            return
+        if not self.link.heard:
+            # Still shaking hands: say hello until challenged, then answer the challenge until the server replies
+            if now - self.last_handshake >= RESEND_INTERVAL:
+                self.last_handshake = now
+                handshake = HANDSHAKE.pack(HELLO, "") if self.cookie is None else HANDSHAKE.pack(RESPONSE, self.cookie)
+                try:
+                    self.socket.send(handshake)
+                except socket.error as e:
+                    if e.args[0] not in WOULD_BLOCK:
+                        self.queue.append({"action": "error", "error": e.args})
+            return
+        for packet in self.link.packets(now):
+            try:
+                self.socket.send(packet)
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK:
+                    self.queue.append({"action": "error", "error": e.args})
+                    return
+
+    def Close(self):
+        """
+        Close the connection.
+        :return: None
+        """
+        if self.link is not None:
+            if not self.link.closed:
+                try:
+                    self.socket.send(self.link.close_packet())
+                except socket.error:
+                    pass
+            self.socket.close()
+            self.link = None
+        self.isConnected = False
+        self.queue.append({"action": "disconnected"})
@@ -0,0 +1,361 @@
+"""
+Front end for running the server on every core. The matchmaker accepts connections and queues clients, and each time
+enough are waiting to start a battle it hands them to one of a pool of worker processes (in a free-for-all, later
+clients join that battle until it's full). Each worker is a TinyServer
+running its own matches and simulation loop. Clients are handed over by passing their sockets between processes, so
+they stay connected to the same address throughout.
+
+Workers report their load and health to the matchmaker every second. New battles go to the worker with the fewest
+live matches, and workers that crash or stop reporting are replaced.
+"""
+import os
+import sys
+import errno
+import signal
+import socket
+import argparse
+import resource
+import multiprocessing
+from time import time
+from collections import deque
+from multiprocessing.reduction import send_handle, recv_handle
+import wire
+import server
+from simulation import PLAYERS
+from transport import Reactor, encode, raise_fd_limit, WOULD_BLOCK
+
+# Clients queued before a new battle is handed to a worker, i.e. enough to start it
+GROUP_SIZE = 2
+
+# Seconds between worker status reports, and how long a worker can go without reporting before it's replaced
+REPORT_INTERVAL = 1
+WORKER_TIMEOUT = 10
+
+# Seconds between worker health summaries in the log
+SUMMARY_INTERVAL = 30
+
+
+class WorkerServer(server.TinyServer):
+    """
+    A TinyServer run by a worker process. It doesn't listen for connections itself, but takes them from the
+    matchmaker over a control pipe, and reports back on the same pipe.
+    """
+    def __init__(self, control, **kwargs):
+        """
+        Set up the worker's server.
+        :multiprocessing.Connection control: Worker's end of the control pipe
+        :return: None
+        """
+        server.TinyServer.__init__(self, localaddr=None, **kwargs)
+        self.control = control
+        self.matchmaker = os.getppid()
+        self.ticks = 0
+        self.reactor.register(control.fileno(), self.ControlHandler(self))
+
+    class ControlHandler(object):
+        """
+        Reactor handler for messages from the matchmaker.
+        """
+        def __init__(self, worker):
+            self.worker = worker
+
+        def handle_read(self):
+            """
+            Take over a client connection from the matchmaker.
+            :return: None
+            """
+            try:
+                action, addr = self.worker.control.recv()
+            except EOFError:
+                sys.exit("Matchmaker has gone away")
+            if action == "adopt":
+                fd = recv_handle(self.worker.control)
+                conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                os.close(fd)
+                self.worker.adopt(conn, tuple(addr))
+
+        def handle_write(self):
+            pass
+
+        def handle_error(self):
+            raise
+
+    def tick(self):
+        """
+        Advance every match by one simulation step, and report to the matchmaker once a second.
+        :return: None
+        """
+        server.TinyServer.tick(self)
+        self.ticks += 1
+        if self.ticks % (self.tick_rate * REPORT_INTERVAL) == 0:
+            if os.getppid() != self.matchmaker:
+                sys.exit("Matchmaker has gone away")
+            self.control.send(("status", self.status()))
+
+
+def run_worker(control, binary, options):
+    """
+    Entry point of a worker process.
+    :multiprocessing.Connection control: Worker's end of the control pipe
+    :bool binary: Send move and bullets messages packed
+    :dict options: TinyServer keyword arguments
+    :return: None
+    """
+    # Close the matchmaker's sockets and pipes inherited when forking, so clients and other workers see them close
+    fd = control.fileno()
+    os.closerange(3, fd)
+    os.closerange(fd + 1, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+    wire.binary = binary
+    worker = WorkerServer(control, **options)
+    control.send(("status", worker.status()))
+    worker.launch_server()
+
+
+class Worker(object):
+    """
+    The matchmaker's view of a worker process.
+    """
+    def __init__(self, number, binary, options):
+        """
+        Start a worker process.
+        :int number: Worker number, for the log
+        :bool binary: Send move and bullets messages packed
+        :dict options: TinyServer keyword arguments
+        :return: None
+        """
+        self.number = number
+        self.control, worker_end = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_worker, args=(worker_end, binary, options),
+                                               name="worker-" + str(number))
+        self.process.daemon = True
+        self.process.start()
+        worker_end.close()
+        self.status = dict()  # Last status reported
+        self.matches = 0  # Live matches, including battles handed over since the last report
+        self.seats = 0  # Free seats in the last battle handed to this worker
+        self.last_report = time()
+
+    def __repr__(self):
+        return "Worker " + str(self.number) + " (pid " + str(self.process.pid) + ")"
+
+    def is_healthy(self):
+        return self.process.is_alive() and time() - self.last_report < WORKER_TIMEOUT
+
+    def hand_over(self, conn, addr):
+        """
+        Pass a client connection to the worker.
+        :socket.socket conn: Client's socket
+        :tuple addr: Client's address
+        :return: None
+        """
+        self.control.send(("adopt", addr))
+        send_handle(self.control, conn.fileno(), self.process.pid)
+
+    def handle_read(self):
+        """
+        Take in a status report from the worker.
+        :return: None
+        """
+        try:
+            action, status = self.control.recv()
+        except (EOFError, IOError):
+            self.last_report = 0  # Replaced at the next health check
+            return
+        if action == "status":
+            self.status = status
+            self.matches = status["matches"]
+            self.last_report = time()
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        self.last_report = 0
+
+    def stop(self):
+        self.process.terminate()
+        self.control.close()
+
+
+class QueuedClient(object):
+    """
+    A client waiting in the matchmaker's queue. The only thing to watch for is the client disconnecting.
+    """
+    def __init__(self, matchmaker, conn, addr):
+        self.matchmaker = matchmaker
+        self.conn = conn
+        self.addr = addr
+
+    def handle_read(self):
+        try:
+            data = self.conn.recv(4096)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            data = ""
+        if not data:
+            self.matchmaker.remove_client(self)
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        self.matchmaker.remove_client(self)
+
+
+class Matchmaker(object):
+    """
+    Accepts connections, queues clients and hands them to workers in groups big enough to start a battle.
+    """
+    def __init__(self, localaddr, workers, binary=True, options=None):
+        """
+        Start listening and launch the workers.
+        :tuple localaddr: (host, port) to listen on
+        :int workers: Number of worker processes
+        :bool binary: Send move and bullets messages packed
+        :dict options: TinyServer keyword arguments for the workers
+        :return: None
+        """
+        self.binary = binary
+        self.options = options or dict()
+        self.players = self.options.get("players", PLAYERS)
+        self.filling = None  # Worker hosting the battle that's still taking players
+        self.reactor = Reactor()
+        self.queue = deque()  # Clients waiting to be handed to a worker
+        self.worker_count = 0
+        self.workers = list()
+        for number in xrange(workers):
+            self.start_worker()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(localaddr)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.reactor.register(self.socket.fileno(), self)
+        self.last_summary = time()
+        print "Matchmaker launched with " + str(workers) + " workers"
+
+    def start_worker(self):
+        """
+        Launch a new worker process.
+        :return: None
+        """
+        self.worker_count += 1
+        worker = Worker(self.worker_count, self.binary, self.options)
+        self.workers.append(worker)
+        self.reactor.register(worker.control.fileno(), worker)
+        print str(worker) + " started"
+
+    def handle_read(self):
+        """
+        Accept every waiting connection and queue the clients.
+        :return: None
+        """
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK + (errno.ECONNABORTED,):
+                    sys.stderr.write("warning: matchmaker accept() failed: " + str(e) + "\n")
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Let the client know it's connected and queued, like the server does when it's full
+            conn.sendall(encode({"action": "connected"}) + encode({"action": "init", "p": "full"}))
+            conn.setblocking(False)
+            client = QueuedClient(self, conn, addr)
+            self.queue.append(client)
+            self.reactor.register(conn.fileno(), client)
+        self.dispatch()
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        import traceback
+        traceback.print_exc()
+
+    def remove_client(self, client):
+        """
+        Drop a client that has disconnected while queued.
+        :QueuedClient client: Client to drop
+        :return: None
+        """
+        if client in self.queue:
+            self.queue.remove(client)
+        self.reactor.unregister(client.conn.fileno())
+        client.conn.close()
+
+    def dispatch(self):
+        """
+        Hand queued clients to workers. Each new battle goes to the least loaded healthy worker once enough clients are
+        queued to start it, and any seats it has left are filled as more clients arrive.
+        :return: None
+        """
+        while self.queue:
+            worker = self.filling
+            if worker is None or not worker.seats or not worker.is_healthy():
+                healthy = [w for w in self.workers if w.is_healthy()]
+                if len(self.queue) < GROUP_SIZE or not healthy:
+                    return
+                worker = self.filling = min(healthy, key=lambda w: w.matches)
+                worker.matches += 1  # Until the worker's next report
+                worker.seats = self.players
+            client = self.queue.popleft()
+            self.reactor.unregister(client.conn.fileno())
+            worker.hand_over(client.conn, client.addr)
+            client.conn.close()
+            worker.seats -= 1
+
+    def check_workers(self):
+        """
+        Replace any worker that has died or stopped reporting, and log a health summary now and then.
+        :return: None
+        """
+        for worker in list(self.workers):
+            if not worker.is_healthy():
+                if worker.process.is_alive():
+                    print str(worker) + " has stopped reporting, replacing it"
+                else:
+                    print str(worker) + " has exited, replacing it"
+                self.reactor.unregister(worker.control.fileno())
+                worker.stop()
+                self.workers.remove(worker)
+                if self.filling is worker:
+                    self.filling = None
+                self.start_worker()
+        if time() - self.last_summary >= SUMMARY_INTERVAL:
+            self.last_summary = time()
+            print "Matchmaker: " + str(len(self.queue)) + " queued"
+            for worker in self.workers:
+                print "  " + str(worker) + ": " + ", ".join(
+                    str(key) + " " + str(value) for key, value in sorted(worker.status.items())) \
+                    + ", last report " + "%.1f" % (time() - worker.last_report) + "s ago"
+        self.dispatch()
+
+    def launch(self):
+        """
+        Main matchmaker loop.
+        :return: None
+        """
+        try:
+            while True:
+                self.reactor.wait(REPORT_INTERVAL)
+                self.check_workers()
+        finally:
+            for worker in self.workers:
+                worker.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiny Space Battles matchmaker (runs a server process per core)")
+    parser.add_argument("address", help="host:port to listen on, e.g. localhost:31425")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: one per core)")
+    server.add_arguments(parser)
+    args = parser.parse_args()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Stop the workers too
+    raise_fd_limit()
+    host, port = args.address.split(":")
+    matchmaker = Matchmaker((host, int(port)), args.workers, not args.dict_wire, server.server_options(args))
+    matchmaker.launch()
@@ -0,0 +1,151 @@
+"""
+Metrics collected by a server while it runs: how long ticks, Pump() and bullet handling take, and how many messages
+and bytes it receives and sends for each action. Nothing is collected unless the server is started with --metrics.
+
+Every interval the server logs one line, "Metrics: " followed by a JSON object, e.g.
+  Metrics: {"bullets": 120, "connections": 8, "interval": 10.0, "received": {"cmd": {"bytes": 19200, ...}}, ...}
+Counts and timings cover the interval since the previous line, while matches, players, bullets, connections and the
+waiting queue are as they were at the end of it. Message sizes are as encoded, before the transport's own framing, and
+messages sent to several clients are counted once per client.
+"""
+import json
+from time import time
+from bisect import bisect_left
+from collections import defaultdict
+from timeit import default_timer
+import wire
+
+# Upper bounds in milliseconds of the timing histograms' buckets (anything longer goes in one last bucket)
+BUCKETS_MS = (0.25, 0.5, 1, 2, 4, 8, 16, 33, 66)
+
+
+class Timer(object):
+    """
+    Adds up the calls made to one function during an interval.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.longest = 0.0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds):
+        """
+        Count a call.
+        :float seconds: Time the call took
+        :return: None
+        """
+        self.calls += 1
+        self.seconds += seconds
+        if seconds > self.longest:
+            self.longest = seconds
+        self.histogram[bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+
+    def report(self):
+        """
+        Summary of the calls.
+        :return: dict
+        """
+        return {"calls": self.calls,
+                "total_ms": self.seconds * 1000,
+                "mean_ms": self.seconds * 1000 / self.calls if self.calls else None,
+                "max_ms": self.longest * 1000,
+                "histogram": [[bound, count] for bound, count in zip(BUCKETS_MS + (None,), self.histogram)]}
+
+
+class Metrics(object):
+    """
+    Counters and timers for one interval of a server's running. The server hands its report to log() at the end of
+    each interval, which starts the next one.
+    """
+    def __init__(self, interval):
+        """
+        Start collecting.
+        :float interval: Seconds between reports
+        :return: None
+        """
+        self.interval = interval
+        self.reset(time())
+
+    def reset(self, now):
+        """
+        Start a new interval.
+        :float now: Current time
+        :return: None
+        """
+        self.started = now
+        self.timers = defaultdict(Timer)  # Name -> Timer
+        self.received = defaultdict(lambda: [0, 0])  # Action -> [messages, bytes]
+        self.sent = defaultdict(lambda: [0, 0])
+
+    def timed(self, name, function):
+        """
+        Call a function and add the time it took to a timer.
+        :str name: Name of the timer
+        :function function: Function to call (with no arguments)
+        :return: What the function returned
+        """
+        start = default_timer()
+        try:
+            return function()
+        finally:
+            self.timers[name].add(default_timer() - start)
+
+    def count_received(self, data, size):
+        """
+        Count a message from a client.
+        :dict data: Message, as decoded (packed messages are counted under the action of the message inside)
+        :int size: Size of the encoded message in bytes
+        :return: None
+        """
+        action = data["action"]
+        if action == "bin":
+            action = wire.unpack(data)["action"]
+        counts = self.received[action]
+        counts[0] += 1
+        counts[1] += size
+
+    def count_sent(self, action, size, copies=1):
+        """
+        Count a message queued for clients.
+        :str action: Action of the message (before it was packed)
+        :int size: Size of the encoded message in bytes
+        :int copies: Number of clients it was queued for
+        :return: None
+        """
+        counts = self.sent[action]
+        counts[0] += copies
+        counts[1] += size * copies
+
+    def is_due(self, now):
+        """
+        Check if the interval is over.
+        :float now: Current time
+        :return: True if it's time for a report
+        """
+        return now - self.started >= self.interval
+
+    def report(self, now):
+        """
+        Summary of the interval so far.
+        :float now: Current time
+        :return: dict
+        """
+        return {"interval": now - self.started,
+                "timers": dict((name, timer.report()) for name, timer in self.timers.iteritems()),
+                "received": dict((action, {"messages": messages, "bytes": size})
+                                 for action, (messages, size) in self.received.iteritems()),
+                "sent": dict((action, {"messages": messages, "bytes": size})
+                             for action, (messages, size) in self.sent.iteritems())}
+
+    def log(self, now, status):
+        """
+        Log the interval's report along with the server's status, and start the next interval.
+        :float now: Current time
+        :dict status: Server status (see TinyServer.status())
+        :return: None
+        """
+        report = self.report(now)
+        report.update(status)
+        print "Metrics: " + json.dumps(report, sort_keys=True)
+        self.reset(now)
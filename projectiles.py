@@ -0,0 +1,310 @@
+import numpy
+from simulation import BULLET_WIDTH, BULLET_HEIGHT, rotated_size, bullet_velocity
+
+# Side length in pixels of each spatial grid cell
+CELL_SIZE = 64
+
+# Building the grid costs about as much as a dozen direct scans of every bullet, so queries only use it when there are
+# at least this many bullets and there were at least this many queries last tick (e.g. matches with lots of ships)
+GRID_MIN_BULLETS = 1000
+GRID_MIN_QUERIES = 12
+
+# Largest bounding box of a rotated bullet, so queries can find bullets that start in a neighbouring cell
+MAX_BULLET_EXTENT = max(max(rotated_size(BULLET_WIDTH, BULLET_HEIGHT, angle)) for angle in xrange(360))
+
+# Cell keys are (row + offset) * stride + (column + offset), so each grid row's cells have consecutive keys
+CELL_OFFSET = 1 << 19
+CELL_STRIDE = 1 << 20
+
+
+class SpatialGrid(object):
+    """
+    Uniform grid broadphase over a ProjectileStore. Each bullet is filed under the cell its top-left corner is in, and
+    the store's rows are kept sorted by cell so all the bullets in a run of cells along a grid row are one contiguous
+    slice. Queries return candidate rows, which callers narrow down with exact checks.
+
+    The index is brought up to date lazily when it's queried. If no bullets have been added or removed since it was
+    last built, it's re-sorted from the previous order, which is nearly sorted already since bullets only move a few
+    pixels a tick.
+
+    Only bullets are indexed, not ships. Ships never collide with each other and a match has at most MAX_PLAYERS of
+    them, so each ship simply makes one query against the bullets. Interest management would need ships indexed too.
+    """
+    def __init__(self, store, cell_size=CELL_SIZE):
+        """
+        Set up an empty index.
+        :ProjectileStore store: Bullets to index
+        :int cell_size: Side length in pixels of each cell
+        :return: None
+        """
+        self.store = store
+        self.cell_size = cell_size
+        self.order = numpy.zeros(0, dtype=numpy.intp)  # Store rows sorted by cell
+        self.keys = numpy.zeros(0, dtype=numpy.int64)  # Cell key of each entry in order
+        self.stamp = None  # (store version, store tick) the index was last built for
+
+    def cell_keys(self, rows):
+        """
+        Cell keys of some of the store's bullets.
+        :numpy.array rows: Rows in the store
+        :return: numpy array of cell keys
+        """
+        column = numpy.floor_divide(self.store.rect_x[rows], self.cell_size).astype(numpy.int64)
+        row = numpy.floor_divide(self.store.rect_y[rows], self.cell_size).astype(numpy.int64)
+        return (row + CELL_OFFSET) * CELL_STRIDE + column + CELL_OFFSET
+
+    def refresh(self):
+        """
+        Bring the index up to date with the store.
+        :return: None
+        """
+        stamp = (self.store.version, self.store.tick)
+        if stamp == self.stamp:
+            return
+        if self.stamp is None or stamp[0] != self.stamp[0]:
+            # Rows have been added or moved, so start again from the store's order
+            self.order = numpy.arange(self.store.count)
+        keys = self.cell_keys(self.order)
+        if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+            sort = numpy.argsort(keys, kind='mergesort')
+            self.order = self.order[sort]
+            keys = keys[sort]
+        self.keys = keys
+        self.stamp = stamp
+
+    def query(self, left, top, right, bottom):
+        """
+        Find bullets that might overlap an area.
+        :int left: Left edge of the area
+        :int top: Top edge of the area
+        :int right: Right edge of the area (exclusive)
+        :int bottom: Bottom edge of the area (exclusive)
+        :return: numpy array of candidate rows in the store
+        """
+        self.refresh()
+        first_column = (left - MAX_BULLET_EXTENT) // self.cell_size + CELL_OFFSET
+        last_column = (right - 1) // self.cell_size + CELL_OFFSET
+        first_row = (top - MAX_BULLET_EXTENT) // self.cell_size + CELL_OFFSET
+        last_row = (bottom - 1) // self.cell_size + CELL_OFFSET
+        rows = numpy.arange(first_row, last_row + 1, dtype=numpy.int64) * CELL_STRIDE
+        starts = numpy.searchsorted(self.keys, rows + first_column, 'left')
+        ends = numpy.searchsorted(self.keys, rows + last_column, 'right')
+        return numpy.concatenate([self.order[start:end] for start, end in zip(starts, ends) if end > start]
+                                 or [self.order[:0]])
+
+
+class ProjectileStore(object):
+    """
+    Struct-of-arrays store for all of a match's bullets. Every per-tick operation (movement, culling and collision
+    detection) runs as a single vectorized pass over the arrays rather than once per bullet.
+
+    Positions are worked out from where and when each bullet was fired, so anyone who knows a bullet's spawn tick,
+    origin and angle can reproduce its trajectory exactly.
+    """
+    def __init__(self, capacity=64):
+        """
+        Allocate the arrays.
+        :int capacity: Number of bullets to allocate space for up front (grows as needed)
+        :return: None
+        """
+        self.count = 0
+        self.tick = 0  # Number of updates so far
+        self.next_id = 1
+        self.version = 0  # Changes whenever bullets are added or removed
+        self._live_ids = None  # (version, ids) cache for live_ids()
+        self.id = numpy.zeros(capacity, dtype=numpy.int64)
+        self.spawn_tick = numpy.zeros(capacity, dtype=numpy.int64)
+        self.x0 = numpy.zeros(capacity, dtype=numpy.int32)
+        self.y0 = numpy.zeros(capacity, dtype=numpy.int32)
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.dx = numpy.zeros(capacity)
+        self.dy = numpy.zeros(capacity)
+        self.angle = numpy.zeros(capacity, dtype=numpy.int16)  # Whole degrees
+        self.owner = numpy.zeros(capacity, dtype=numpy.int32)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        # Integer bounding box of each bullet (same as the rect of the rotated bullet sprite)
+        self.rect_x = numpy.zeros(capacity, dtype=numpy.int32)
+        self.rect_y = numpy.zeros(capacity, dtype=numpy.int32)
+        self.width = numpy.zeros(capacity, dtype=numpy.int32)
+        self.height = numpy.zeros(capacity, dtype=numpy.int32)
+        self.grid = SpatialGrid(self)  # Broadphase index, for collision and area queries
+        self.queries = 0  # Number of queries so far this tick
+        self.last_queries = 0  # Number of queries last tick
+
+    def __len__(self):
+        return self.count
+
+    def _arrays(self):
+        return ('id', 'spawn_tick', 'x0', 'y0', 'x', 'y', 'dx', 'dy', 'angle', 'owner', 'alive',
+                'rect_x', 'rect_y', 'width', 'height')
+
+    def _grow(self):
+        """
+        Double the capacity of every array.
+        :return: None
+        """
+        for name in self._arrays():
+            old = getattr(self, name)
+            new = numpy.zeros(len(old) * 2, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, x, y, angle, speed, owner):
+        """
+        Add a bullet at the current tick.
+        :int x: Starting x position
+        :int y: Starting y position
+        :int angle: Direction of travel in whole degrees
+        :float speed: Distance travelled per tick
+        :int owner: ID of the player that fired the bullet
+        :return: ID of the new bullet
+        """
+        if self.count == len(self.x):
+            self._grow()
+        i = self.count
+        x = int(x)
+        y = int(y)
+        angle = int(round(angle)) % 360
+        self.id[i] = self.next_id
+        self.spawn_tick[i] = self.tick
+        self.x0[i] = x
+        self.y0[i] = y
+        self.x[i] = x
+        self.y[i] = y
+        self.dx[i], self.dy[i] = bullet_velocity(angle, speed)
+        self.angle[i] = angle
+        self.owner[i] = owner
+        self.alive[i] = True
+        self.rect_x[i] = x
+        self.rect_y[i] = y
+        self.width[i], self.height[i] = rotated_size(BULLET_WIDTH, BULLET_HEIGHT, angle)
+        self.count += 1
+        self.next_id += 1
+        self.version += 1
+        return int(self.id[i])
+
+    def update(self):
+        """
+        Move every bullet one tick along its trajectory.
+        :return: None
+        """
+        self.tick += 1
+        self.last_queries, self.queries = self.queries, 0
+        n = self.count
+        age = self.tick - self.spawn_tick[:n]
+        self.x[:n] = self.x0[:n] + self.dx[:n] * age
+        self.y[:n] = self.y0[:n] + self.dy[:n] * age
+        # Truncate towards zero like pygame.Rect does
+        self.rect_x[:n] = self.x[:n]
+        self.rect_y[:n] = self.y[:n]
+
+    def cull(self, left, top, right, bottom):
+        """
+        Kill every bullet whose position has left the given bounds.
+        :int left: Smallest x position allowed
+        :int top: Smallest y position allowed
+        :int right: Largest x position allowed
+        :int bottom: Largest y position allowed
+        :return: None
+        """
+        n = self.count
+        rect_x = self.rect_x[:n]
+        rect_y = self.rect_y[:n]
+        self.alive[:n] &= (rect_x >= left) & (rect_x <= right) & (rect_y >= top) & (rect_y <= bottom)
+
+    def query(self, left, top, right, bottom):
+        """
+        Find the live bullets overlapping an area.
+        :int left: Left edge of the area
+        :int top: Top edge of the area
+        :int right: Right edge of the area (exclusive)
+        :int bottom: Bottom edge of the area (exclusive)
+        :return: numpy array of rows in the store
+        """
+        self.queries += 1
+        if self.count >= GRID_MIN_BULLETS and self.last_queries >= GRID_MIN_QUERIES:
+            rows = self.grid.query(left, top, right, bottom)
+        else:
+            rows = numpy.arange(self.count)
+        rect_x = self.rect_x[rows]
+        rect_y = self.rect_y[rows]
+        overlap = self.alive[rows] \
+            & (rect_x < right) & (rect_x + self.width[rows] > left) \
+            & (rect_y < bottom) & (rect_y + self.height[rows] > top)
+        return rows[overlap]
+
+    def collide(self, rect, ignore_owner):
+        """
+        Kill every live bullet overlapping a rectangle.
+        :Ship rect: Rectangle to test against, anything with x, y, width and height (e.g. a ship)
+        :int ignore_owner: Bullets fired by this player are ignored
+        :return: numpy array of the owners of the bullets that hit, oldest bullet first
+        """
+        rows = self.query(rect.x, rect.y, rect.x + rect.width, rect.y + rect.height)
+        hits = numpy.sort(rows[self.owner[rows] != ignore_owner])
+        self.alive[hits] = False
+        return self.owner[hits]
+
+    def compact(self):
+        """
+        Drop dead bullets, keeping live ones packed at the start of the arrays.
+        :return: numpy array of the IDs of the bullets dropped
+        """
+        n = self.count
+        keep = numpy.flatnonzero(self.alive[:n])
+        if len(keep) == n:
+            return self.id[:0]
+        dropped = self.id[:n][~self.alive[:n]]
+        for name in self._arrays():
+            array = getattr(self, name)
+            array[:len(keep)] = array[keep]
+        self.alive[len(keep):n] = False
+        self.count = len(keep)
+        self.version += 1
+        return dropped
+
+    def remove_owner(self, owner):
+        """
+        Remove every bullet fired by a player.
+        :int owner: ID of the player
+        :return: numpy array of the IDs of the bullets removed
+        """
+        self.alive[:self.count] &= self.owner[:self.count] != owner
+        return self.compact()
+
+    def clear(self):
+        """
+        Remove all bullets.
+        :return: numpy array of the IDs of the bullets removed
+        """
+        self.alive[:self.count] = False
+        return self.compact()
+
+    def locations(self):
+        """
+        Locations of all live bullets, in the format sent to clients.
+        :return: list of bullet locations, each entry a tuple (x, y, angle)
+        """
+        n = self.count
+        live = self.alive[:n]
+        return zip(self.rect_x[:n][live].tolist(), self.rect_y[:n][live].tolist(), self.angle[:n][live].tolist())
+
+    def live_ids(self):
+        """
+        IDs of all live bullets. Only valid straight after compact().
+        :return: Sorted numpy array of IDs (shared between calls while no bullets are added or removed)
+        """
+        if self._live_ids is None or self._live_ids[0] != self.version:
+            self._live_ids = (self.version, self.id[:self.count].copy())
+        return self._live_ids[1]
+
+    def spawn_records(self, ids):
+        """
+        Everything needed to reproduce the trajectories of some live bullets. Only valid straight after compact().
+        :numpy.array ids: Sorted IDs of the bullets
+        :return: list of records, each a tuple (id, spawn tick, x, y, angle)
+        """
+        rows = numpy.searchsorted(self.id[:self.count], ids)
+        return zip(ids.tolist(), self.spawn_tick[rows].tolist(), self.x0[rows].tolist(), self.y0[rows].tolist(),
+                   self.angle[rows].tolist())
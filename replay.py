@@ -0,0 +1,353 @@
+"""
+Match replays. A server started with --record DIR writes every match it hosts to its own file in DIR, one frame per
+tick: where each ship is, its health, and the bullets in flight. Bullets are stored as the records their trajectories
+are worked out from (see ProjectileStore), so a frame only holds the bullets fired and removed since the frame before,
+except every KEYFRAME_INTERVAL ticks, when a keyframe holds every live bullet.
+
+File layout (numbers are big-endian):
+* FILE_HEADER
+* One frame per tick: FRAME_HEADER, a SHIP for each seat, BULLET records for the bullets fired since the last frame
+  (every live bullet in a keyframe), then the IDs of the bullets removed since the last frame
+* Index: the offset of each tick's frame (0 for a tick that wasn't recorded)
+* TRAILER, giving where the index starts
+
+Replay memory-maps a file and finds a tick's frame through the index, and the keyframe it builds on from the frame's
+header, so seeking takes the same time however long the match went on. A file whose server didn't shut down cleanly has
+no index, so it's rebuilt by reading through the frames once when the file is opened.
+
+Frames are packed during the tick but written to disk by a background thread, so the tick loop never waits for the
+disk. If the writer falls too far behind, frames are dropped (and the next frame recorded is a keyframe) rather than
+holding up the server.
+"""
+import os
+import sys
+import mmap
+import struct
+import argparse
+import threading
+from time import time, strftime
+from Queue import Queue
+import numpy
+from wire import NO_HEALTH, ANGLE_SCALE, clamp
+from simulation import player_name, trajectory_locs
+
+# Bumped whenever the layout of a replay file changes
+REPLAY_VERSION = 1
+MAGIC = "TSBR"
+
+# Ticks between keyframes, i.e. the most frames read to rebuild any tick
+KEYFRAME_INTERVAL = 120
+
+# Most frames waiting to be written before frames are dropped, and the buffer size of each file
+MAX_BACKLOG = 3600
+WRITE_BUFFER = 1 << 16
+
+FILE_HEADER = struct.Struct("!4sHHdBId")  # Magic, version, tick rate, bullet speed, seats, match ID, start time
+FRAME_HEADER = struct.Struct("!IIHII")  # Tick, bullet tick, ticks since keyframe, bullet count, removed count
+SHIP = struct.Struct("!hhHh")  # x, y, angle (tenths of a degree), health (NO_HEALTH for an empty seat)
+BULLET = numpy.dtype([("id", ">u4"), ("spawn_tick", ">u4"), ("x", ">i2"), ("y", ">i2"), ("angle", ">u2")])
+REMOVED = numpy.dtype(">u4")  # ID of a bullet removed
+INDEX = numpy.dtype(">u8")  # Offset of a frame
+TRAILER = struct.Struct("!QI4s")  # Index offset, ticks, magic
+
+
+class Recorder(object):
+    """
+    Records a server's matches, writing them out on a background thread.
+    """
+    def __init__(self, directory):
+        """
+        Start the writer thread.
+        :str directory: Directory to write replays to (created if it doesn't exist)
+        :return: None
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.recordings = set()  # Recordings that haven't been closed
+        self.dropped = 0  # Frames dropped because the writer was behind
+        self.queue = Queue()  # (action, recording, ...) for the writer, None to stop it
+        self.thread = threading.Thread(target=self.run, name="replay-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start(self, match, tick_rate, bullet_speed):
+        """
+        Start recording a match.
+        :Match match: Match to record
+        :int tick_rate: Simulation steps per second
+        :float bullet_speed: Bullet speed in pixels per tick
+        :return: Recording, to record each tick of the match with
+        """
+        recording = Recording(self, len(match.slots))
+        path = os.path.join(self.directory,
+                            strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + "-" + str(match.id) + ".replay")
+        header = FILE_HEADER.pack(MAGIC, REPLAY_VERSION, tick_rate, bullet_speed, len(match.slots), match.id, time())
+        self.queue.put(("open", recording, path, header))
+        self.recordings.add(recording)
+        return recording
+
+    def write(self, recording, tick, data):
+        """
+        Queue a frame to be written, unless the writer is too far behind.
+        :Recording recording: Recording the frame belongs to
+        :int tick: Tick of the frame
+        :str data: Packed frame
+        :return: True if the frame was queued, False if it was dropped
+        """
+        if self.queue.qsize() >= MAX_BACKLOG:
+            self.dropped += 1
+            return False
+        self.queue.put(("frame", recording, tick, data))
+        return True
+
+    def finish(self, recording):
+        """
+        Stop recording a match, writing out the replay's index.
+        :Recording recording: Recording to close
+        :return: None
+        """
+        self.recordings.discard(recording)
+        self.queue.put(("close", recording))
+
+    def close(self):
+        """
+        Finish every recording and wait for the writer to write everything out.
+        :return: None
+        """
+        for recording in list(self.recordings):
+            self.finish(recording)
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """
+        Writer thread: write frames as they're queued, flushing the files whenever the queue is empty.
+        :return: None
+        """
+        files = dict()  # Recording -> [file, offset of each tick's frame, bytes written]
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            action, recording = item[:2]
+            try:
+                if action == "open":
+                    path, header = item[2:]
+                    replay_file = open(path, "wb", WRITE_BUFFER)
+                    replay_file.write(header)
+                    files[recording] = [replay_file, list(), len(header)]
+                elif recording in files:
+                    replay_file, offsets, size = files[recording]
+                    if action == "frame":
+                        tick, data = item[2:]
+                        offsets.extend([0] * (tick - len(offsets)))  # Ticks dropped since the last frame
+                        offsets.append(size)
+                        replay_file.write(data)
+                        files[recording][2] += len(data)
+                    elif action == "close":
+                        del files[recording]
+                        replay_file.write(numpy.array(offsets, INDEX).tobytes())
+                        replay_file.write(TRAILER.pack(size, len(offsets), MAGIC))
+                        replay_file.close()
+            except (IOError, OSError) as e:
+                sys.stderr.write("warning: stopped recording a replay: " + str(e) + "\n")
+                files.pop(recording, None)
+            if self.queue.empty():
+                for recording, (replay_file, offsets, size) in files.items():
+                    try:
+                        replay_file.flush()
+                    except (IOError, OSError) as e:
+                        sys.stderr.write("warning: stopped recording a replay: " + str(e) + "\n")
+                        del files[recording]
+
+
+class Recording(object):
+    """
+    Packs each tick of one match for its Recorder.
+    """
+    def __init__(self, recorder, seats):
+        """
+        Set up the recording.
+        :Recorder recorder: Recorder writing the replay
+        :int seats: Seats in the match
+        :return: None
+        """
+        self.recorder = recorder
+        self.seats = seats
+        self.tick = 0  # Tick of the next frame
+        self.since_keyframe = None  # Ticks since the last keyframe recorded (None to record a keyframe next)
+        self.ids = None  # IDs of the live bullets in the last frame recorded
+
+    def record(self, match):
+        """
+        Record the match as it is at the end of a tick.
+        :Match match: Match being recorded
+        :return: None
+        """
+        store = match.projectiles
+        ids = store.live_ids()
+        keyframe = self.since_keyframe is None or self.since_keyframe + 1 >= KEYFRAME_INTERVAL
+        if keyframe:
+            spawned, removed = ids, ids[:0]
+        elif ids is self.ids:
+            spawned = removed = ids[:0]
+        else:
+            spawned = ids[~numpy.in1d(ids, self.ids, assume_unique=True)]
+            removed = self.ids[~numpy.in1d(self.ids, ids, assume_unique=True)]
+
+        rows = numpy.searchsorted(store.id[:store.count], spawned)
+        bullets = numpy.empty(len(rows), BULLET)
+        bullets["id"] = spawned
+        bullets["spawn_tick"] = store.spawn_tick[rows]
+        bullets["x"] = store.x0[rows]
+        bullets["y"] = store.y0[rows]
+        bullets["angle"] = store.angle[rows]
+
+        parts = [FRAME_HEADER.pack(self.tick, store.tick, 0 if keyframe else self.since_keyframe + 1, len(bullets),
+                                   len(removed))]
+        for player in match.slots:
+            if player is None:
+                parts.append(SHIP.pack(0, 0, 0, NO_HEALTH))
+            else:
+                ship = player.ship
+                parts.append(SHIP.pack(clamp(ship.x, -32768, 32767), clamp(ship.y, -32768, 32767),
+                                       int(round(ship.angle * ANGLE_SCALE)) % (360 * ANGLE_SCALE),
+                                       clamp(ship.health, NO_HEALTH + 1, 32767)))
+        parts.append(bullets.tobytes())
+        parts.append(removed.astype(REMOVED).tobytes())
+
+        if self.recorder.write(self, self.tick, "".join(parts)):
+            self.since_keyframe = 0 if keyframe else self.since_keyframe + 1
+            self.ids = ids
+        else:
+            self.since_keyframe = None
+        self.tick += 1
+
+    def close(self):
+        """
+        Stop recording.
+        :return: None
+        """
+        self.recorder.finish(self)
+
+
+class Replay(object):
+    """
+    A recorded match, read from a memory-mapped replay file.
+    """
+    def __init__(self, path):
+        """
+        Open a replay.
+        :str path: Path of the replay file
+        :return: None
+        """
+        with open(path, "rb") as replay_file:
+            self.data = mmap.mmap(replay_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.tick_rate, self.bullet_speed, self.seats, self.match_id, self.started = \
+            FILE_HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(path + " isn't a replay")
+        if version != REPLAY_VERSION:
+            raise ValueError("Unsupported replay version " + str(version))
+        self.complete = len(self.data) >= FILE_HEADER.size + TRAILER.size and self.data[-len(MAGIC):] == MAGIC
+        if self.complete:
+            index_offset, ticks, magic = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+            self.index = numpy.frombuffer(self.data, INDEX, ticks, index_offset)
+        else:
+            self.index = self.scan()
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame_size(self, bullets, removed):
+        return FRAME_HEADER.size + self.seats * SHIP.size + bullets * BULLET.itemsize + removed * REMOVED.itemsize
+
+    def scan(self):
+        """
+        Rebuild the index of a file that doesn't have one by reading through its frames.
+        :return: numpy array of the offset of each tick's frame (0 for a tick that wasn't recorded)
+        """
+        offsets = list()
+        offset = FILE_HEADER.size
+        while offset + FRAME_HEADER.size <= len(self.data):
+            tick, bullet_tick, since_keyframe, bullets, removed = FRAME_HEADER.unpack_from(self.data, offset)
+            size = self.frame_size(bullets, removed)
+            if offset + size > len(self.data):
+                break  # Cut off part way through writing
+            offsets.extend([0] * (tick - len(offsets)))
+            offsets.append(offset)
+            offset += size
+        return numpy.array(offsets, INDEX)
+
+    def frame(self, tick):
+        """
+        Read a tick's frame.
+        :int tick: Tick to read
+        :return: (header tuple, ships, bullets, removed), with bullets a numpy array of BULLET records
+        """
+        offset = int(self.index[tick])
+        if not offset:
+            raise ValueError("Tick " + str(tick) + " wasn't recorded")
+        header = FRAME_HEADER.unpack_from(self.data, offset)
+        bullets, removed = header[3:]
+        offset += FRAME_HEADER.size
+        ships = [SHIP.unpack_from(self.data, offset + seat * SHIP.size) for seat in xrange(self.seats)]
+        offset += self.seats * SHIP.size
+        records = numpy.frombuffer(self.data, BULLET, bullets, offset)
+        offset += bullets * BULLET.itemsize
+        return header, ships, records, numpy.frombuffer(self.data, REMOVED, removed, offset)
+
+    def state(self, tick):
+        """
+        Rebuild the match as it was at the end of a tick, starting from the keyframe before it.
+        :int tick: Tick to rebuild (negative to count back from the end)
+        :return: dict of the tick, bullet tick, each seat's ship and health, and the live bullets
+        """
+        if tick < 0:
+            tick += len(self.index)
+        if not 0 <= tick < len(self.index):
+            raise IndexError("Tick " + str(tick) + " is outside the replay")
+        header, ships, records, removed = self.frame(tick)
+        bullets = dict()  # ID -> (spawn tick, x, y, angle), as the client keeps them
+        for frame_tick in xrange(tick - header[2], tick + 1):
+            header, ships, records, removed = self.frame(frame_tick)
+            for bullet_id in removed.tolist():
+                bullets.pop(bullet_id, None)
+            for bullet_id, spawn_tick, x, y, angle in records.tolist():
+                bullets[bullet_id] = (spawn_tick, x, y, angle)
+        return {"tick": tick,
+                "bullet_tick": header[1],
+                "ships": [None if health == NO_HEALTH else (x, y, float(angle) / ANGLE_SCALE)
+                          for x, y, angle, health in ships],
+                "health": [None if health == NO_HEALTH else health for x, y, angle, health in ships],
+                "bullets": bullets}
+
+    def bullet_locs(self, state):
+        """
+        Work out where the bullets are in a rebuilt tick.
+        :dict state: Tick from state()
+        :return: list of bullet locations, each entry a tuple (x, y, angle)
+        """
+        return trajectory_locs(state["bullets"], state["bullet_tick"], self.bullet_speed)
+
+    def close(self):
+        self.data.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show what happened in a recorded Tiny Space Battles match")
+    parser.add_argument("path", help="replay file, written by a server started with --record")
+    parser.add_argument("--tick", type=int, nargs="+", default=[-1], metavar="N",
+                        help="ticks to show (negative to count back from the end, default: the last tick)")
+    args = parser.parse_args()
+
+    replay = Replay(args.path)
+    print "Match " + str(replay.match_id) + ": " + str(len(replay)) + " ticks at " + str(replay.tick_rate) \
+        + " per second, " + str(replay.seats) + " seats" + ("" if replay.complete else " (index rebuilt)")
+    for tick in args.tick:
+        state = replay.state(tick)
+        print "Tick " + str(state["tick"]) + ": " + str(len(state["bullets"])) + " bullets"
+        for seat, (ship, health) in enumerate(zip(state["ships"], state["health"])):
+            if ship is not None:
+                print "  " + player_name(seat).upper() + " at (%d, %d) facing %.1f, health %d" % (ship + (health,))
@@ -0,0 +1,53 @@
+from time import time, sleep
+
+
+class FixedTimestep(object):
+    """
+    Schedules simulation steps at a fixed rate, independent of how fast the surrounding loop spins.
+    """
+    def __init__(self, rate, max_catchup=5, clock=time):
+        """
+        Set up the schedule.
+        :int rate: Number of steps per second
+        :int max_catchup: Most steps to run back to back after a stall before dropping the backlog
+        :function clock: Function returning the current time in seconds
+        :return: None
+        """
+        self.rate = rate
+        self.step = 1.0 / rate
+        self.max_catchup = max_catchup
+        self.clock = clock
+        self.tick = 0
+        self.dropped = 0  # Steps skipped because the loop fell too far behind
+        self.deadline = clock()
+
+    def due(self):
+        """
+        Work out how many steps should run now and advance the schedule past them.
+        :return: Number of steps to run (never more than max_catchup)
+        """
+        now = self.clock()
+        steps = 0
+        while now >= self.deadline and steps < self.max_catchup:
+            self.deadline += self.step
+            steps += 1
+        if now >= self.deadline:
+            # Still behind after catching up, so drop the backlog instead of spiralling
+            self.dropped += int((now - self.deadline) / self.step) + 1
+            self.deadline = now + self.step
+        self.tick += steps
+        return steps
+
+    def time_left(self):
+        """
+        Time until the next step is due.
+        :return: Seconds until the next deadline (0 if it has already passed)
+        """
+        return max(0.0, self.deadline - self.clock())
+
+    def wait(self):
+        """
+        Sleep until the next step is due.
+        :return: None
+        """
+        sleep(self.time_left())
@@ -1,18 +1,39 @@
 import sys
-import os
-import pygame
+import argparse
+import numpy
+import wire
+from time import time
 from collections import deque
-from time import sleep
-from tinySpaceBattles import Bullet, Starship
-from PodSixNet.Server import Server
-from PodSixNet.Channel import Channel
+from scheduler import FixedTimestep
+from projectiles import ProjectileStore
+from simulation import X_DIM, Y_DIM, HIT_DAMAGE, BULLET_MARGIN, PLAYERS, MAX_PLAYERS, FIRE, Ship, player_name, \
+    move_ship
+from metrics import Metrics
+from replay import Recorder
+from transport import Server, Channel, encode, raise_fd_limit
+from datagram import DatagramChannel, DatagramListener
 
-X_DIM = 1000
-Y_DIM = 700
-SCREENSIZE = (X_DIM, Y_DIM)
+# Maximum number of matches a single server process will host before queueing clients
+MAX_MATCHES = 256
 
+# Simulation steps per second, and the most steps to run back to back after the server stalls
+TICK_RATE = 60
+MAX_CATCHUP_STEPS = 5
 
-class ServerChannel(object, Channel):
+# Bullet speed in pixels per second (converted to pixels per tick by the server)
+BULLET_SPEED = 600
+
+# How bullets are sent to clients: every bullet location each tick ("full"), only spawns, despawns and health
+# changes against the last snapshot each client has acknowledged ("delta"), or one event when each bullet is fired
+# and one when it's removed, with clients simulating the bullets in between ("events")
+BULLET_SYNC_MODES = ("full", "delta", "events")
+BULLET_SYNC = "delta"
+
+# Number of ticks of snapshots kept as delta baselines
+SNAPSHOT_HISTORY = 120
+
+
+class ServerChannel(Channel):
     """
     This is the server representation of a single connected client.
     """
@@ -20,9 +41,12 @@ class ServerChannel(object, Channel):
         Channel.__init__(self, *args, **kwargs)
         self.id = str(self._server.next_id())
         self._player_pos = [0, 0]
-        self.p1 = None
-        self.sprite = Starship()  # Each player needs a sprite representation
-        self.bullets = pygame.sprite.Group()  # Each player has their own list of bullets
+        self.slot = None  # Seat in the match (None while waiting in the queue)
+        self.match = None  # Match this client is playing in (None while waiting in the queue)
+        self.acked_snapshot = None  # Latest bullet snapshot the client has acknowledged
+        self.full_snapshot = None  # Last bullet snapshot sent to the client in full (reliably)
+        self.last_command = None  # Number of the last command frame applied
+        self.ship = None  # Simulation representation of the player's ship (only while seated in a match)
 
     @property
     def player_pos(self):
@@ -30,23 +54,35 @@ class ServerChannel(object, Channel):
 
     @player_pos.setter
     def player_pos(self, value):
-        self.sprite.update(value)
-        self._player_pos = self.sprite.rect.x, self.sprite.rect.y
+        self.ship.update(value)
+        self._player_pos = self.ship.x, self.ship.y
 
     def which_player(self):
-        return str("p1") if self.p1 else str("p2")
+        return player_name(self.slot)
+
+    def fire(self):
+        """
+        Fire a bullet from where the player is.
+        :return: None
+        """
+        x, y = self.ship.center
+        bullet_id = self.match.projectiles.spawn(x, y, self.ship.angle, self._server.bullet_speed, int(self.id))
+        if self.match.bullet_sync == "events":
+            self.match.send_to_all({"action": "spawn",
+                                    "b": self.match.projectiles.spawn_records(numpy.array([bullet_id]))})
 
     def pass_on(self, data):
         """
-        Pass data to all connected clients
+        Pass data to every other client in this player's match (the player's own client already knows it)
         :dict data: Data to forward to clients
         :return: None
         """
-        self._server.send_to_all(data)
+        if self.match is not None:
+            self.match.send([player for player in self.match.players if player is not self], data)
 
     def Close(self):
         """
-        PodSixNet-defined callback for closing connection.
+        Transport callback for when the connection closes.
         :return:
         """
         self._server.delete_player(self)
@@ -55,27 +91,56 @@ class ServerChannel(object, Channel):
     ### Network specific callbacks ###
     ##################################
 
+    def Network_bin(self, data):
+        """
+        Processes a packed message from client by unpacking it and handing it to the matching callback, if there is one.
+        :dict data: Data from client.
+        :return: None
+        """
+        message = wire.unpack(data)
+        getattr(self, "Network_" + message["action"], lambda message: None)(message)
+
     def Network_move(self, data):
         """
-        Processes move data from client.
+        Processes move data from client, which places the ship when the player joins or restarts.
         :dict data: Data from client.
         :return: None
         """
+        if self.match is None:
+            return
         self.player_pos = data['p_pos']
         self.pass_on(data)
 
-    def Network_fire(self, data):
+    def Network_cmd(self, data):
+        """
+        Processes a command frame from client: the movement and buttons pressed during one client tick. Frames are
+        applied in order, moving the ship first and then firing from where it ends up. Firing is ignored unless the
+        battle is on, since bullets only move while it is. The client is sent back where its ship is and the frame it's
+        up to, so it can correct its prediction.
+        :dict data: Data from client.
+        :return: None
         """
-        Processes fire data from client.
+        if self.match is None or self.last_command is not None and data['n'] <= self.last_command:
+            return
+        self.last_command = data['n']
+        dx, dy, turn = data['m']
+        if dx or dy or turn:
+            loc = list(move_ship((self.ship.x, self.ship.y, self.ship.angle), self.slot, dx, dy, turn))
+            self.player_pos = loc
+            self.pass_on({"action": "move", "p": self.which_player(), "p_pos": loc})
+        if data['b'] & FIRE and self.match.ready and self.ship.health > 0:
+            self.fire()
+        self.match.send([self], {"action": "state", "p": self.which_player(), "n": self.last_command,
+                                 "p_pos": [self.ship.x, self.ship.y, self.ship.angle]})
+
+    def Network_ack(self, data):
+        """
+        Processes acknowledgement of a bullet snapshot from client.
         :dict data: Data from client.
         :return: None
         """
-        bullet = Bullet(self.sprite.angle)
-        # Set the bullet so it is where the player is
-        bullet.x = self.sprite.rect.center[0]
-        bullet.y = self.sprite.rect.center[1]
-        # Add the bullet to the list
-        self.bullets.add(bullet)
+        if self.acked_snapshot is None or data['s'] > self.acked_snapshot:
+            self.acked_snapshot = data['s']
 
     def Network_restart(self, data):
         """
@@ -83,106 +148,152 @@ class ServerChannel(object, Channel):
         :dict data: Data from client.
         :return: None
         """
-        self._server.restart()
+        if self.match is not None:
+            self.match.restart()
 
 
-class TinyServer(object, Server):
-    channelClass = ServerChannel
+class DatagramServerChannel(DatagramChannel, ServerChannel):
+    """
+    A client connected over UDP.
+    """
 
-    def __init__(self, *args, **kwargs):
-        self.id = 0
-        Server.__init__(self, *args, **kwargs)
-        self.p1 = None
-        self.p2 = None
+
+class Match(object):
+    """
+    A single battle between two or more players. Each match owns its seats, the players' bullets and its ready state,
+    so one server process can host many matches at once. The last ship left alive wins.
+    """
+    def __init__(self, match_id, bullet_sync=BULLET_SYNC, max_players=PLAYERS, metrics=None):
+        self.id = match_id
+        self.slots = [None] * max_players  # Player in each seat (None for an empty seat)
         self.ready = False
-        self.waiting_player_list = deque()  # Make a FIFO queue for waiting clients (no limit to waiting clients)
-        print 'Server launched'
+        self.game_over = False  # True from when a player wins until the match restarts
+        self.scores = dict()  # Player ID -> kills
+        self.projectiles = ProjectileStore()  # Bullets fired by every player
+        self.bullet_sync = bullet_sync
+        self.snapshots = dict()  # Snapshot ID -> (live bullet IDs, health of each seat)
+        self.snapshot_ids = deque()  # Snapshot IDs in the order they were taken
+        self.metrics = metrics  # Server's metrics (None if it isn't collecting any)
+        self.recording = None  # Replay being recorded (None if the server isn't recording matches)
+
+    def __repr__(self):
+        return "Match " + str(self.id)
 
-    ###########################
-    ### PodSixNet callbacks ###
-    ###########################
+    @property
+    def players(self):
+        return [player for player in self.slots if player is not None]
 
-    def Connected(self, channel, addr):
+    def alive_players(self):
+        return [player for player in self.slots if player is not None and player.ship.health > 0]
+
+    def is_full(self):
+        return None not in self.slots
+
+    def is_empty(self):
+        return not self.players
+
+    def health(self):
         """
-        PodSixNet-defined callback for when a cient connects.
-        :ServerChannel channel: Representation of player
-        :str addr: IP address of channel
-        :return: None
+        Health of the ship in each seat.
+        :return: list with an entry for each seat (None for an empty seat)
         """
-        if self.p1 and self.p2:
-            channel.Send({"action": "init", "p": "full"})
-            self.waiting_player_list.append(channel)
-        else:
-            self.add_player(channel)
+        return [player.ship.health if player is not None else None for player in self.slots]
 
-    ########################
-    ### Server functions ###
-    ########################
-
-    def next_id(self):
+    def player_by_id(self, player_id):
         """
-        Generates unique ID for each client.
-        :return: ID number for client
+        Find a player in the match from their client ID (the owner recorded on their bullets).
+        :int player_id: Client ID
+        :return: ServerChannel, or None if they're not in the match
         """
-        self.id += 1
-        return self.id
+        for player in self.players:
+            if int(player.id) == player_id:
+                return player
+        return None
 
     def add_player(self, player):
         """
-        Adds new player.
-        :ServerChannel player: PLayer to add.
+        Adds new player to the match.
+        :ServerChannel player: Player to add.
         :return: None
         """
-        # Determine if P1 or P2
-        if self.p1 is None:
-            self.p1 = player
-            player.p1 = True
-            print "New P1 (" + str(player.addr) + ")"
-        elif self.p1 and self.p2 is None:
-            self.p2 = player
-            player.p1 = False
-            print "New P2 (" + str(player.addr) + ")"
-        else:
-            sys.stderr.write("ERROR: Couldn't determine player from client (P1 = "
-                             + str(self.p1) + ",  P2 = "
-                             + str(self.p2) + ".\n")
+        if self.is_full():
+            sys.stderr.write("ERROR: Couldn't seat player in full " + str(self) + " (" + str(self.slots) + ").\n")
             sys.stderr.flush()
             sys.exit(1)
-        # If only P1, tell client they're P1
-        if self.p2 is None:
-            player.Send({"action": "init", "p": 'p1'})
-        # Else if P2, notify P2 and send position data
-        else:
-            self.p2.Send({"action": "init", "p": 'p2'})
+        player.slot = self.slots.index(None)
+        self.slots[player.slot] = player
+        player.match = self
+        player.ship = Ship()
+        player.acked_snapshot = None
+        player.full_snapshot = None
+        player.last_command = None
+        self.scores[player.which_player()] = 0
+        print str(self) + ": New " + player.which_player().upper() + " (" + str(player.addr) + ")"
+
+        # Tell the client which player they are, how many seats there are and how to simulate bullets
+        player.Send({"action": "init", "p": player.which_player(), "players": len(self.slots),
+                     "tick_rate": player._server.tick_rate, "bullet_speed": player._server.bullet_speed}, barrier=True)
+
+        others = [other for other in self.players if other is not player]
+        if not others:
+            return
+
+        # Send the new player everyone else's position
+        for other in others:
+            loc = list(other.player_pos)
+            loc.append(other.ship.angle)
+            self.send([player], {"action": "move", "p": other.which_player(), "p_pos": loc})
+        if self.bullet_sync == "events":
+            # Bring the new player up to date with bullets already in flight
+            player.Send({"action": "spawn",
+                         "b": self.projectiles.spawn_records(self.projectiles.live_ids()),
+                         "health": self.health()})
+
+        # Start the battle now there's someone to fight (a new player waits for the restart if it's already over)
+        if self.ready:
+            player.Send({"action": "ready"})
+        elif not self.game_over:
             self.send_to_all({"action": "ready"})
-            # Only send position data from P1 -> P2
-            loc = list(self.p1.player_pos)
-            loc.append(self.p1.sprite.angle)
-            self.send_to_all({"action": "move", "p": "p1", "p_pos": loc})
             self.ready = True
 
     def delete_player(self, player):
         """
-        Deletes player from server.
-        :ServerChannel player: PLayer to delete.
-        :return:
+        Deletes player from the match.
+        :ServerChannel player: Player to delete.
+        :return: None
         """
-        self.ready = False
-        if self.p1 is player:
-            self.p1 = None
-            self.send_to_all({"action": "player_left"})
-            print "Deleted P1 (" + str(player.addr) + ")"
-        elif self.p2 is player:
-            self.p2 = None
-            self.send_to_all({"action": "player_left"})
-            print "Deleted P2 (" + str(player.addr) + ")"
-        elif player in self.waiting_player_list:
-            self.waiting_player_list.remove(player)
-        else:
+        if player.match is not self or self.slots[player.slot] is not player:
             print("ERROR: Can't delete player")
-        # Pull waiting player from queue
-        if self.waiting_player_list:
-            self.add_player(self.waiting_player_list.popleft())
+            return
+        self.slots[player.slot] = None
+        del self.scores[player.which_player()]
+        player.match = None
+        player.ship = None
+        removed = self.projectiles.remove_owner(int(player.id))
+        if self.bullet_sync == "events" and len(removed):
+            self.send_despawns(removed)
+        self.send_to_all({"action": "player_left", "p": player.which_player()})
+        print "Deleted " + player.which_player().upper() + " (" + str(player.addr) + ") from " + str(self)
+
+        # Carry on while there's still a battle (the player who left may have been the last one standing against the
+        # winner)
+        if len(self.players) < 2:
+            self.ready = False
+        elif self.ready:
+            self.check_game_over()
+
+    def tick(self):
+        """
+        Advance the match by one simulation step.
+        :return: None
+        """
+        if self.ready:
+            if self.metrics is None:
+                self.handle_bullets()
+            else:
+                self.metrics.timed("handle_bullets", self.handle_bullets)
+        if self.recording is not None:
+            self.recording.record(self)
 
     def handle_bullets(self):
         """
@@ -190,134 +301,415 @@ class TinyServer(object, Server):
         :return: None
         """
         # Check if there are bullets (if all bullets are cleared, still should update screen to clear bullets)
-        player_had_bullets = True if (self.p1.bullets or self.p2.bullets) else False
+        player_had_bullets = len(self.projectiles) > 0
 
         # Update bullet positions
-        self.p1.bullets.update()
-        self.p2.bullets.update()
+        self.projectiles.update()
 
         # Do collision detection
-        self.handle_bullet_hits(self.p1)
-        self.handle_bullet_hits(self.p2)
-
-        # Generate position list
-        bullet_list = self.gen_bullet_locs()
+        deaths = list()
+        for player in self.alive_players():
+            killer = self.handle_bullet_hits(player)
+            if player.ship.health <= 0:
+                deaths.append((player, killer))
 
         # Send new bullet lists
-        if bullet_list or player_had_bullets:
-            self.send_to_all({"action": "bullets",
-                              "bullets": bullet_list,
-                              "p1_health": self.p1.sprite.health,
-                              "p2_health": self.p2.sprite.health})
+        if self.bullet_sync == "full":
+            bullet_list = self.gen_bullet_locs()
+            if bullet_list or player_had_bullets:
+                self.send_to_all({"action": "bullets",
+                                  "bullets": bullet_list,
+                                  "health": self.health()})
+        else:
+            removed = self.remove_stray_bullets()
+            if self.bullet_sync == "delta":
+                self.send_deltas()
+            elif len(removed):
+                self.send_despawns(removed)
 
-        # If any of the players have died, let both players know
-        if self.p1.sprite.health <= 0 or self.p2.sprite.health <= 0:
-            self.handle_death()
+        # If any of the players have died, let everyone know
+        for player, killer in deaths:
+            self.handle_death(player, killer)
+        if deaths:
+            self.check_game_over()
 
-    def handle_death(self):
+    def handle_death(self, player, killer):
         """
         Process the death of a player.
+        :ServerChannel player: Player who has died
+        :ServerChannel killer: Player whose bullet finished them off (None if they've left)
         :return: None
         """
-        if self.p1.sprite.health <= 0:
-            dead = self.p1.which_player()
-            print("P1 has died")
-        else:
-            dead = self.p2.which_player()
-            print("P2 has died")
+        dead = player.which_player()
+        if killer is not None:
+            self.scores[killer.which_player()] += 1
+        print str(self) + ": " + dead.upper() + " has died"
         # Send message to clients that a player has died
-        self.send_to_all({"action": "death", "p": dead})
+        self.send_to_all({"action": "death", "p": dead, "killer": killer.which_player() if killer else None})
+
+    def check_game_over(self):
+        """
+        End the battle if no more than one ship is left.
+        :return: None
+        """
+        alive = self.alive_players()
+        if len(alive) > 1:
+            return
+        winner = alive[0].which_player() if alive else None
+        print str(self) + ": " + (winner.upper() + " has won" if winner else "Nobody survived")
+        self.send_to_all({"action": "game_over", "winner": winner, "scores": self.scores})
         self.ready = False
+        self.game_over = True
 
     def restart(self):
         """
         Handle game restart.
         :return: None
         """
-        if self.p1 and self.p2:
-            self.p1.sprite.reset_health()
-            self.p2.sprite.reset_health()
+        if len(self.players) >= 2:
+            for player in self.players:
+                player.ship.reset_health()
 
-            # Clear bullet lists
-            self.p1.bullets.empty()
-            self.p2.bullets.empty()
-            self.send_to_all({"action": "bullets",
-                              "bullets": list(),
-                              "p1_health": self.p1.sprite.health,
-                              "p2_health": self.p2.sprite.health})
+            # Clear bullet lists (in delta mode the next snapshot tells clients)
+            removed = self.projectiles.clear()
+            if self.bullet_sync == "full":
+                self.send_to_all({"action": "bullets",
+                                  "bullets": list(),
+                                  "health": self.health()})
+            elif self.bullet_sync == "events":
+                self.send_despawns(removed)
 
             # Notify clients
             self.send_to_all({"action": "restart"})
             self.ready = True
+            self.game_over = False
 
     def gen_bullet_locs(self):
         """
         Generate locations of bullets to send to players.
         :return: list of bullet locations
         """
-        bullet_locs = list()
-        for player in {self.p1, self.p2}:
-            for bullet in player.bullets:
-                # Remove the bullet if it flies off the screen
-                if bullet.rect.x < -15 or bullet.rect.x > (X_DIM + 15) \
-                        or bullet.rect.y < -15 or bullet.rect.y > (X_DIM + 15):
-                    bullet.kill()
-                    break
-                # If we're here, bullet is still moving and should be sent to clients
-                bullet_locs.append((bullet.rect.x, bullet.rect.y, bullet.angle))
-        return bullet_locs
+        self.remove_stray_bullets()
+        return self.projectiles.locations()
+
+    def remove_stray_bullets(self):
+        """
+        Remove bullets that have hit a player or flown off the screen.
+        :return: numpy array of the IDs of the bullets removed
+        """
+        self.projectiles.cull(-BULLET_MARGIN, -BULLET_MARGIN, X_DIM + BULLET_MARGIN, Y_DIM + BULLET_MARGIN)
+        return self.projectiles.compact()
+
+    def send_despawns(self, ids):
+        """
+        Tell clients that bullets have been removed, along with the players' health.
+        :numpy.array ids: IDs of the bullets removed
+        :return: None
+        """
+        self.send_to_all({"action": "despawn",
+                          "ids": ids.tolist(),
+                          "health": self.health()})
+
+    def take_snapshot(self):
+        """
+        Record the live bullets and health at the current tick.
+        :return: Snapshot ID (the tick number)
+        """
+        snapshot_id = self.projectiles.tick
+        self.snapshots[snapshot_id] = (self.projectiles.live_ids(), tuple(self.health()))
+        self.snapshot_ids.append(snapshot_id)
+        while len(self.snapshot_ids) > SNAPSHOT_HISTORY:
+            del self.snapshots[self.snapshot_ids.popleft()]
+        return snapshot_id
+
+    def send_deltas(self):
+        """
+        Send each client the bullets spawned and despawned, and any health change, since the last snapshot they
+        acknowledged. Clients that haven't acknowledged anything still held get the full state, sent reliably as it
+        can be too big for a single datagram; until they acknowledge it, they're sent changes since that full
+        snapshot rather than the full state again. Nothing is sent to clients that are already up to date.
+        :return: None
+        """
+        snapshot_id = self.take_snapshot()
+        ids, health = self.snapshots[snapshot_id]
+        for player in self.players:
+            if player.acked_snapshot in self.snapshots:
+                baseline = player.acked_snapshot
+                baseline_ids, baseline_health = self.snapshots[baseline]
+            elif player.full_snapshot in self.snapshots:
+                # Still on its way; the client drops changes against it that arrive first
+                baseline = player.full_snapshot
+                baseline_ids, baseline_health = self.snapshots[baseline]
+            else:
+                baseline = -1
+                baseline_ids, baseline_health = ids[:0], None
+
+            if baseline_ids is ids:
+                spawned = despawned = ids[:0]
+            else:
+                spawned = ids[~numpy.in1d(ids, baseline_ids, assume_unique=True)]
+                despawned = baseline_ids[~numpy.in1d(baseline_ids, ids, assume_unique=True)]
+            if baseline != -1 and not len(spawned) and not len(despawned) and health == baseline_health:
+                continue
+
+            frame = {"action": "delta",
+                     "s": snapshot_id,
+                     "b": baseline,
+                     "spawn": self.projectiles.spawn_records(spawned),
+                     "despawn": despawned.tolist()}
+            if health != baseline_health:
+                frame["health"] = list(health)
+            if baseline == -1:
+                player.full_snapshot = snapshot_id
+                player.Send(frame)
+            else:
+                player.Send(frame, wire.SNAPSHOT_STREAM)
 
     def handle_bullet_hits(self, player):
         """
         Perform collision detection on bullets.
         :ServerChannel player: Player to check number of hits on
-        :return: None
+        :return: Player whose bullet hit last (None if no bullets hit)
         """
-        if player.p1:
-            other_player = self.p2
-        else:
-            other_player = self.p1
-
-        # Perform collision detection
-        bullets_hit = pygame.sprite.spritecollide(player.sprite, other_player.bullets, False)
+        # Perform collision detection against the other players' bullets
+        owners = self.projectiles.collide(player.ship, int(player.id))
+        if not len(owners):
+            return None
 
         # For each block hit, subtract health
-        for bullet in bullets_hit:
-            player.sprite.health -= 10
-            bullet.kill()
+        player.ship.health -= HIT_DAMAGE * len(owners)
+        return self.player_by_id(int(owners[-1]))
 
     def send_to_all(self, data):
         """
-        Send data to all connected clients.
+        Send data to all clients in the match.
+        :param data: Data to send
+        :return: None
+        """
+        self.send(self.players, data)
+
+    def send(self, players, data):
+        """
+        Send data to some of the clients in the match. Messages are packed (if they're move or bullets messages) and
+        encoded once and the result is sent to everyone.
+        :list players: Players to send to
         :param data: Data to send
         :return: None
         """
-        if self.p1 is not None:
-            self.p1.Send(data)
-        if self.p2 is not None:
-            self.p2.Send(data)
+        action = data["action"]
+        stream = wire.stream(data)
+        barrier = wire.is_barrier(data)
+        if wire.binary and wire.is_packable(data):
+            data = wire.pack(data)
+        outgoing = encode(data)
+        if self.metrics is not None:
+            self.metrics.count_sent(action, len(outgoing), len(players))
+        for player in players:
+            player.send_encoded(outgoing, stream, barrier)
+
+
+class TinyServer(Server):
+    channelClass = ServerChannel
+
+    def __init__(self, *args, **kwargs):
+        self.id = 0
+        self.match_id = 0
+        self.max_matches = kwargs.pop('max_matches', MAX_MATCHES)
+        self.tick_rate = kwargs.pop('tick_rate', TICK_RATE)
+        self.bullet_sync = kwargs.pop('bullet_sync', BULLET_SYNC)
+        self.players = kwargs.pop('players', PLAYERS)  # Seats in each match
+        self.bullet_speed = float(BULLET_SPEED) / self.tick_rate  # Pixels per tick
+        self.scheduler = None  # Simulation schedule (set up when the server is launched)
+        udp = kwargs.pop('udp', False)
+        metrics_interval = kwargs.pop('metrics_interval', None)
+        replay_dir = kwargs.pop('replay_dir', None)
+        Server.__init__(self, *args, **kwargs)
+        if metrics_interval:
+            self.metrics = Metrics(metrics_interval)
+        self.recorder = Recorder(replay_dir) if replay_dir else None  # Records matches (None if not recording)
+        self.datagrams = None  # Listener for clients connecting over UDP (None if only TCP is enabled)
+        if udp:
+            DatagramListener(self, kwargs['localaddr'], DatagramServerChannel)
+        self.matches = list()  # All matches currently hosted by this server
+        self.waiting_player_list = deque()  # Make a FIFO queue for waiting clients (no limit to waiting clients)
+        print 'Server launched'
+
+    ###########################
+    ### Transport callbacks ###
+    ###########################
+
+    def Connected(self, channel, addr):
+        """
+        Transport callback for when a client connects.
+        :ServerChannel channel: Representation of player
+        :str addr: IP address of channel
+        :return: None
+        """
+        match = self.open_match()
+        if match is None:
+            channel.Send({"action": "init", "p": "full"}, barrier=True)
+            self.waiting_player_list.append(channel)
+        else:
+            match.add_player(channel)
+
+    ########################
+    ### Server functions ###
+    ########################
+
+    def next_id(self):
+        """
+        Generates unique ID for each client.
+        :return: ID number for client
+        """
+        self.id += 1
+        return self.id
+
+    def next_match_id(self):
+        """
+        Generates unique ID for each match.
+        :return: ID number for match
+        """
+        self.match_id += 1
+        return self.match_id
+
+    def open_match(self):
+        """
+        Find a match with a free slot, creating a new one if the server has capacity.
+        :return: Match with a free slot, or None if the server is full
+        """
+        for match in self.matches:
+            if not match.is_full():
+                return match
+        if len(self.matches) < self.max_matches:
+            match = Match(self.next_match_id(), self.bullet_sync, self.players, self.metrics)
+            if self.recorder is not None:
+                match.recording = self.recorder.start(match, self.tick_rate, self.bullet_speed)
+            self.matches.append(match)
+            return match
+        return None
+
+    def pair_waiting_players(self):
+        """
+        Move clients from the waiting queue into matches with free slots.
+        :return: None
+        """
+        while self.waiting_player_list:
+            match = self.open_match()
+            if match is None:
+                break
+            match.add_player(self.waiting_player_list.popleft())
+
+    def delete_player(self, player):
+        """
+        Deletes player from server.
+        :ServerChannel player: PLayer to delete.
+        :return:
+        """
+        if player.match is not None:
+            match = player.match
+            match.delete_player(player)
+            if match.is_empty():
+                self.matches.remove(match)
+                if match.recording is not None:
+                    match.recording.close()
+        elif player in self.waiting_player_list:
+            self.waiting_player_list.remove(player)
+        else:
+            print("ERROR: Can't delete player")
+        # Pull waiting players from queue
+        self.pair_waiting_players()
+
+    def tick(self):
+        """
+        Advance every match by one simulation step.
+        :return: None
+        """
+        for match in self.matches:
+            match.tick()
+
+    def status(self):
+        """
+        Summary of the server's load and health.
+        :return: dict
+        """
+        return {"matches": len(self.matches),
+                "players": sum(len(match.players) for match in self.matches),
+                "waiting": len(self.waiting_player_list),
+                "connections": len(self.channels),
+                "bullets": sum(len(match.projectiles) for match in self.matches),
+                "ticks": self.scheduler.tick if self.scheduler else 0,
+                "dropped_ticks": self.scheduler.dropped if self.scheduler else 0}
 
     def launch_server(self):
         """
-        Main server loop.
+        Main server loop. Network traffic is handled as it arrives, while the simulation steps at a fixed tick rate.
+        Everything queued for a client during a tick is sent together at the end of it. Replays being recorded are
+        finished when the loop exits.
         :return: None
         """
-        while True:
-            self.Pump()
-            if self.ready:
-                self.handle_bullets()
-            sleep(0.001)  # 0.01, 0.0001?
-
-# Assign dummy SDL screen and init headless PyGame
-os.environ["SDL_VIDEODRIVER"] = "dummy"
-pygame.init()
-screen = pygame.display.set_mode((1, 1))
-
-# get command line argument of server, port
-if len(sys.argv) != 2:
-    print "Usage:", sys.argv[0], "host:port"
-    print "e.g.", sys.argv[0], "localhost:31425"
-else:
-    host, port = sys.argv[1].split(":")
-    s = TinyServer(localaddr=(host, int(port)))
+        self.scheduler = scheduler = FixedTimestep(self.tick_rate, MAX_CATCHUP_STEPS)
+        metrics = self.metrics
+        try:
+            while True:
+                steps = scheduler.due()
+                if metrics is None:
+                    for step in xrange(steps):
+                        self.tick()
+                    if steps:
+                        self.Pump()
+                elif steps:
+                    for step in xrange(steps):
+                        metrics.timed("tick", self.tick)
+                    metrics.timed("pump", self.Pump)
+                    now = time()
+                    if metrics.is_due(now):
+                        metrics.log(now, self.status())
+                if self.datagrams is not None:
+                    self.datagrams.service()
+                self.wait(scheduler.time_left())
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+
+def add_arguments(parser):
+    """
+    Add the game options shared by the server and the matchmaker to a command line parser.
+    :argparse.ArgumentParser parser: Parser to add the options to
+    :return: None
+    """
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE, help="simulation steps per second")
+    parser.add_argument("--bullet-sync", choices=BULLET_SYNC_MODES, default=BULLET_SYNC,
+                        help="send every bullet location each tick (full), only changes clients haven't acknowledged "
+                             "(delta) or one event per bullet spawn and despawn (events)")
+    parser.add_argument("--players", type=int, choices=range(2, MAX_PLAYERS + 1), default=PLAYERS, metavar="N",
+                        help="ships per match (2 for duels, more for a free-for-all)")
+    parser.add_argument("--dict-wire", action="store_true", help="send move and bullets messages as plain dicts")
+    parser.add_argument("--metrics", type=float, metavar="SECONDS",
+                        help="log tick timings, message counts and load as a JSON line every SECONDS (off by default)")
+    parser.add_argument("--record", metavar="DIR", help="record a replay of every match in DIR (see replay.py)")
+
+
+def server_options(args):
+    """
+    TinyServer keyword arguments for parsed game options.
+    :argparse.Namespace args: Options added by add_arguments()
+    :return: dict
+    """
+    return {"tick_rate": args.tick_rate, "bullet_sync": args.bullet_sync, "players": args.players,
+            "metrics_interval": args.metrics, "replay_dir": args.record}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiny Space Battles server")
+    parser.add_argument("address", help="host:port to listen on, e.g. localhost:31425")
+    add_arguments(parser)
+    parser.add_argument("--udp", action="store_true",
+                        help="also accept clients over UDP on the same port (for clients started with --udp)")
+    args = parser.parse_args()
+    wire.binary = not args.dict_wire
+
+    raise_fd_limit()
+    host, port = args.address.split(":")
+    s = TinyServer(localaddr=(host, int(port)), udp=args.udp, **server_options(args))
     s.launch_server()
@@ -0,0 +1,180 @@
+"""
+Game rules and entities shared by the server and client. This module only uses the standard library, so the server
+can run the simulation without loading SDL, a display, images or fonts.
+"""
+import math
+from random import randrange
+
+X_DIM = 1000
+Y_DIM = 700
+SCREENSIZE = (X_DIM, Y_DIM)
+
+# 194 due to 1:1 mapping of health blocks in bar to health attribute
+MAX_HEALTH = 194
+
+# Health lost for each bullet hit
+HIT_DAMAGE = 10
+
+# Size of a ship's hitbox, and of a bullet before rotation
+SHIP_WIDTH = 120
+SHIP_HEIGHT = 75
+BULLET_WIDTH = 10
+BULLET_HEIGHT = 3
+
+# How far off the screen a bullet can fly before it's removed
+BULLET_MARGIN = 15
+
+# Distance a ship moves for each movement input (scaled by how far the Nunchuck joystick is pushed), and degrees it
+# turns for each rotation input
+MOVE_STEP = 8
+TURN_STEP = 5
+
+# Size of the ship images before rotation (images/p1.png for even seats, images/p2.png for odd seats). Ships rotate
+# about the centre of their image, so the server needs these to move ships exactly as the client draws them.
+SHIP_IMAGE_SIZES = ((126, 75), (142, 75))
+
+# Command frame buttons
+FIRE = 1
+SHIELD = 2
+
+# Ships per match: two for a duel, more for a free-for-all
+PLAYERS = 2
+MAX_PLAYERS = 64
+
+
+def player_name(slot):
+    """
+    Player ID used in messages for a seat in a match.
+    :int slot: Seat number, starting at 0
+    :return: Player ID ("p1", "p2", ...)
+    """
+    return "p" + str(slot + 1)
+
+
+def player_slot(name):
+    """
+    Seat number of a player ID.
+    :str name: Player ID ("p1", "p2", ...)
+    :return: Seat number, starting at 0
+    """
+    return int(name[1:]) - 1
+
+
+def bullet_velocity(angle, speed):
+    """
+    Distance a bullet moves each tick.
+    :int angle: Direction of travel in degrees
+    :float speed: Distance travelled per tick
+    :return: (dx, dy) tuple
+    """
+    return math.cos(math.radians(angle)) * speed, math.sin(math.radians(-angle)) * speed
+
+
+def trajectory_locs(bullets, tick, speed):
+    """
+    Work out where bullets are from where and when they were fired.
+    :dict bullets: Bullet records keyed by ID, each a tuple (spawn tick, x, y, angle)
+    :float tick: Server tick to work out the positions for (may be between ticks)
+    :float speed: Distance travelled per tick
+    :return: list of bullet locations, each entry a tuple (x, y, angle)
+    """
+    locs = list()
+    for spawn_tick, x, y, angle in bullets.itervalues():
+        age = tick - spawn_tick
+        dx, dy = bullet_velocity(angle, speed)
+        locs.append((int(x + dx * age), int(y + dy * age), angle))
+    return locs
+
+
+def rotated_size(width, height, angle):
+    """
+    Size of the bounding box of a width x height image rotated by angle (same result as pygame.transform.rotate).
+    :int width: Width of the unrotated image
+    :int height: Height of the unrotated image
+    :int angle: Rotation in degrees
+    :return: (width, height) tuple
+    """
+    if angle % 90 == 0:
+        return (width, height) if (angle // 90) % 2 == 0 else (height, width)
+    rad = math.radians(angle)
+    cos = abs(math.cos(rad))
+    sin = abs(math.sin(rad))
+    return int(cos * width + sin * height), int(sin * width + cos * height)
+
+
+def move_ship(loc, slot, dx, dy, turn):
+    """
+    Apply one command frame's movement to a ship. Both the client and the server move ships with this, so they agree
+    on where a ship is given the same frames.
+    :tuple loc: Ship location (x, y, angle), where (x, y) is the top left of its rotated image
+    :int slot: Seat number of the player, starting at 0
+    :int dx: Distance to move right
+    :int dy: Distance to move down
+    :int turn: Rotation steps to turn anticlockwise (negative for clockwise)
+    :return: New location as an (x, y, angle) tuple
+    """
+    x, y, angle = loc
+    x, y = int(x + dx), int(y + dy)
+    if turn:
+        # Keep the centre of the rotated image where it was, as pygame's get_rect(center=...) does
+        width, height = SHIP_IMAGE_SIZES[slot % 2]
+        old_width, old_height = rotated_size(width, height, angle)
+        angle = (angle + turn * TURN_STEP) % 360
+        new_width, new_height = rotated_size(width, height, angle)
+        x = x + old_width / 2 - new_width / 2
+        y = y + old_height / 2 - new_height / 2
+    return x, y, angle
+
+
+def start_position(slot, players=PLAYERS):
+    """
+    Random starting position for a player. Even seats start on the left facing right and odd seats on the right facing
+    left, with each pair of seats spread down the screen.
+    :int slot: Seat number, starting at 0
+    :int players: Number of seats in the match
+    :return: (x, y, angle) tuple
+    """
+    rows = (players + 1) / 2
+    centre = Y_DIM * (2 * (slot / 2) + 1) / (2 * rows)
+    spread = min(50, Y_DIM / (4 * rows))
+    if slot % 2 == 0:
+        return randrange(0, 50), randrange(centre - spread, centre + spread), 0
+    else:
+        return randrange(X_DIM-180, X_DIM-150), randrange(centre - spread, centre + spread), 180
+
+
+class Ship(object):
+    """
+    Simulation representation of a player's ship: position, angle, health and an image-free hitbox. Uses __slots__
+    since the server holds one per seated player.
+    """
+    __slots__ = ('x', 'y', 'angle', 'health')
+
+    # Hitbox size (the same for every ship, and unchanged by rotation like the client sprite's rect)
+    width = SHIP_WIDTH
+    height = SHIP_HEIGHT
+
+    def __init__(self):
+        self.x = randrange(0, 100)
+        self.y = randrange(200, 300)
+        self.angle = 0
+        self.health = MAX_HEALTH
+
+    @property
+    def center(self):
+        return self.x + self.width / 2, self.y + self.height / 2
+
+    def reset_health(self):
+        """
+        Reset the ship's health.
+        :return: None
+        """
+        self.health = MAX_HEALTH
+
+    def update(self, loc):
+        """
+        Called to update the ship's location.
+        :list loc: New ship location [x, y, angle]
+        :return: None
+        """
+        self.x, self.y, self.angle = loc
@@ -1,9 +1,11 @@
 from sys import exit
 from os import environ
 import pygame
-import math
 from random import randrange
-from collections import deque
+from collections import deque, OrderedDict
+from itertools import islice
+from simulation import X_DIM, SCREENSIZE, MAX_HEALTH, SHIP_WIDTH, SHIP_HEIGHT, BULLET_WIDTH, BULLET_HEIGHT, PLAYERS, \
+    start_position, player_name, player_slot
 
 # Define some colors
 BLACK = (0,   0,   0)
@@ -12,10 +14,6 @@ GREEN = (0, 255,   0)
 RED = (255,   0,   0)
 BLUE = (0,   0, 255)
 
-X_DIM = 1000
-Y_DIM = 700
-SCREENSIZE = (X_DIM, Y_DIM)
-
 # Nunchuck joystick threshold
 JOY_THRESH = 0.08
 
@@ -46,20 +44,94 @@ keyboard_fire = {pygame.K_SPACE: 'f'}  # *space*
 
 keyboard_restart = {pygame.K_j: 'restart'}
 
-environ['SDL_VIDEO_CENTERED'] = '1'
-pygame.init()
-screen = pygame.display.set_mode(SCREENSIZE)
-pygame.display.set_caption("Tiny Space Battles")
-background_image = pygame.image.load("images/bg.png")
-win_lose_bg_image = pygame.image.load("images/win_lose_bg.png")
-healthbar = pygame.image.load("images/healthbar.png")
-healthbar_slices = pygame.image.load("images/health.png")
+# Display, images and fonts (loaded by init_display())
+screen = None
+background_image = None
+win_lose_bg_image = None
+healthbar = None
+healthbar_slices = None
+ship_images = None  # Unrotated ship image on the left (P1's) and right (P2's), shared by every ship
+fnt = None
+fnt_big = None
+fnt_med = None
+
+# Screen areas covered by the HUD (health bars and status labels)
+HUD_RECTS = [pygame.Rect(0, 0, 400, 60), pygame.Rect(X_DIM - 210, 0, 210, 30)]
+
+# Past this many changed areas in a frame, dirty-rect mode updates the whole screen instead
+MAX_DIRTY_RECTS = 400
+
+# Moves kept for replaying on top of the server's position, i.e. about two seconds of movement at 60 frames a second
+MOVE_HISTORY = 120
+
+
+class RotationCache(object):
+    """
+    Cache of rotated images shared by every sprite, keyed by the original image and the angle rounded to whole
+    degrees. Rotations are done lazily the first time they're needed, and once the cache holds max_size images the
+    least recently used is dropped to make room. The default size holds every angle of both ship images and the bullet.
+    """
+    def __init__(self, max_size=3 * 360):
+        self.max_size = max_size
+        self.images = OrderedDict()  # Least recently used first
+
+    def rotate(self, image, angle):
+        """
+        Get an image rotated by an angle.
+        :pygame.Surface image: Image to rotate
+        :float angle: Angle in degrees
+        :return: pygame.Surface
+        """
+        key = (image, int(round(angle)) % 360)
+        rotated = self.images.pop(key, None)
+        if rotated is None:
+            if len(self.images) >= self.max_size:
+                self.images.popitem(last=False)
+            rotated = pygame.transform.rotate(image, key[1])
+        self.images[key] = rotated
+        return rotated
+
+rotation_cache = RotationCache()
+
 
-pygame.font.init()
-fnt = pygame.font.SysFont("Arial", 14)
-fnt_big = pygame.font.SysFont("Arial", 50)
-fnt_med = pygame.font.SysFont("Arial", 30)
-txtpos = (100, 90)
+def init_display():
+    """
+    Open the game window and load the images and fonts used to draw it. Only the client renderer needs these, so
+    they're loaded on first use rather than when the module is imported.
+    :return: None
+    """
+    global screen, background_image, win_lose_bg_image, healthbar, healthbar_slices, ship_images, fnt, fnt_big, fnt_med
+    if screen is not None:
+        return
+    environ['SDL_VIDEO_CENTERED'] = '1'
+    pygame.init()
+    screen = pygame.display.set_mode(SCREENSIZE)
+    pygame.display.set_caption("Tiny Space Battles")
+    background_image = pygame.image.load("images/bg.png")
+    win_lose_bg_image = pygame.image.load("images/win_lose_bg.png")
+    healthbar = pygame.image.load("images/healthbar.png")
+    healthbar_slices = pygame.image.load("images/health.png")
+    ship_images = {True: pygame.image.load("images/p1.png").convert_alpha(),
+                   False: pygame.image.load("images/p2.png").convert_alpha()}
+
+    pygame.font.init()
+    fnt = pygame.font.SysFont("Arial", 14)
+    fnt_big = pygame.font.SysFont("Arial", 50)
+    fnt_med = pygame.font.SysFont("Arial", 30)
+
+_bullet_image = []
+
+
+def bullet_image():
+    """
+    Get the unrotated bullet image shared by every bullet (created on first use).
+    :return: pygame.Surface
+    """
+    if not _bullet_image:
+        image = pygame.Surface([BULLET_WIDTH, BULLET_HEIGHT])
+        image.fill(GREEN)
+        _bullet_image.append(image.convert_alpha())
+    return _bullet_image[0]
 
 
 class Starship(pygame.sprite.Sprite):
@@ -76,15 +148,14 @@ class Starship(pygame.sprite.Sprite):
         super(Starship, self).__init__()
         self.health = 0
         self.angle = 0
-        self.position_hist = deque(iter([]), 10)
-        self.image = pygame.Surface([120, 75])
+        self.position_hist = deque(iter([]), MOVE_HISTORY)  # (command frame number, [dx, dy, turn]) not yet confirmed
+        self.image = pygame.Surface([SHIP_WIDTH, SHIP_HEIGHT])
         self.colour = BLACK
         self.image.fill(self.colour)
         self.image_orig = self.image
         self.rect = self.image.get_rect()
         self.rect.x = randrange(0, 100)
         self.rect.y = randrange(200, 300)
-        self.bullets = pygame.sprite.Group()
         self.reset_health()
 
     @property
@@ -98,10 +169,10 @@ class Starship(pygame.sprite.Sprite):
 
     def reset_health(self):
         """
-        Reset the player's health (194 due to 1:1 mapping of health blocks in bar to health attribute).
+        Reset the player's health.
         :return: None
         """
-        self.health = 194
+        self.health = MAX_HEALTH
 
     def update(self, loc, assign_new_center=False):
         """
@@ -123,61 +194,45 @@ class Starship(pygame.sprite.Sprite):
         :return: None
         """
         new_center = self.rect.center
-        self.image = pygame.transform.rotate(self.image_orig, angle)
+        self.image = rotation_cache.rotate(self.image_orig, angle)
         if assign_new_center:
             self.rect = self.image.get_rect(center=new_center)
+        else:
+            self.rect = self.image.get_rect(topleft=self.rect.topleft)
         self.angle = angle
 
     def set_graphic(self, p1):
         """
-        Set a player's sprite to an image.
+        Set a player's sprite to an image (shared with every other ship using it, so they share rotations too).
         :bool p1: True if setting P1's sprite, False otherwise
         :return: None
         """
-        if p1:
-            self.image = pygame.image.load("images/p1.png")
-        else:
-            self.image = pygame.image.load("images/p2.png")
-        self.image_orig = self.image
-        self.image.convert_alpha()
+        self.image = self.image_orig = ship_images[p1]
         self.rect = self.image.get_rect()
 
-    def rand_pos(self, p1):
+    def rand_pos(self, slot, players=PLAYERS):
         """
         Randomize position of sprite.
-        :bool p1: True if setting P1's sprite, False otherwise
+        :int slot: Seat number of the player, starting at 0
+        :int players: Number of seats in the match
         :return: None
         """
+        x, y, angle = start_position(slot, players)
         self.rotate(0)
-        if p1:
-            self.rect_xy = (randrange(0, 50), randrange((Y_DIM/2)-50, (Y_DIM/2)+50))
-        else:
-            self.rect_xy = (randrange(X_DIM-180, X_DIM-150), randrange((Y_DIM/2)-50, (Y_DIM/2)+50))
-            self.rotate(180)
-
-    def set_p1(self, p1):
-        """
-        Set graphic and randomize position of sprite.
-        :bool p1: True if setting P1's sprite, False otherwise
-        :return: None
-        """
-        if p1:
-            self.set_graphic(True)
-            self.rand_pos(True)
-        else:
-            self.set_p2(True)
+        self.rect_xy = (x, y)
+        if angle:
+            self.rotate(angle)
 
-    def set_p2(self, p2):
+    def set_slot(self, slot, players=PLAYERS):
         """
-        Set graphic and randomize position of sprite.
-        :bool p2: True if setting P2's sprite, False otherwise
+        Set graphic and randomize position of sprite. Players on the left get P1's graphic and players on the right
+        get P2's.
+        :int slot: Seat number of the player, starting at 0
+        :int players: Number of seats in the match
         :return: None
         """
-        if p2:
-            self.set_graphic(False)
-            self.rand_pos(False)
-        else:
-            self.set_p1(True)
+        self.set_graphic(slot % 2 == 0)
+        self.rand_pos(slot, players)
 
     def draw(self, surface):
         """
@@ -188,61 +243,153 @@ class Starship(pygame.sprite.Sprite):
         surface.blit(self.image, self.rect)
 
 
-class Bullet(pygame.sprite.Sprite):
-    """ This class represents the bullet . """
-    def __init__(self, angle):
-        # Call the parent class (Sprite) constructor
-        super(Bullet, self).__init__()
-        self.angle = angle
-        self.image = pygame.Surface([10, 3])
-        self.image.fill(GREEN)
-        self.image_orig = self.image.convert_alpha()
-        self.image = pygame.transform.rotate(self.image_orig, self.angle)
-        self.rect = self.image.get_rect()
-        self.bullet_speed = 1
-        self.x = 0
-        self.y = 0
-        self.dx = math.cos(math.radians(self.angle)) * self.bullet_speed
-        self.dy = math.sin(math.radians(-self.angle)) * self.bullet_speed
-
-    def update(self):
-        """ Move the bullet (PyGame-dictated function and signature). """
-        self.x += self.dx
-        self.y += self.dy
-        self.rect.x = self.x
-        self.rect.y = self.y
-
-    def set_loc(self, x, y):
-        """ Update the bullet's position. """
-        # Set position
-        self.rect.x = x
-        self.rect.y = y
+class BulletPool(object):
+    """
+    Client-side bullet renderer. Bullet positions are written into a pool of reusable rects, every bullet at the same
+    angle shares one image from the rotation cache, and the whole pool is drawn with a single batched blit.
+    """
+    def __init__(self):
+        self.entries = list()  # Reusable [image, rect] pairs, the first self.count of which are in use
+        self.count = 0
 
-    def get_loc(self):
-        """ Return bullet position. """
-        return [self.rect.x, self.rect.y]
+    def __len__(self):
+        return self.count
+
+    def update(self, bullets):
+        """
+        Reposition the pool's bullets.
+        :list bullets: All bullet locations with each location entry a list [x, y, angle]
+        :return: None
+        """
+        while len(self.entries) < len(bullets):
+            self.entries.append([None, pygame.Rect(0, 0, 0, 0)])
+        image_orig = bullet_image()
+        images = dict()  # Angle -> image for this update, to skip the shared cache's key normalization per bullet
+        for entry, (x, y, angle) in zip(self.entries, bullets):
+            image = images.get(angle)
+            if image is None:
+                image = images[angle] = rotation_cache.rotate(image_orig, angle)
+            entry[0] = image
+            rect = entry[1]
+            rect.x = x
+            rect.y = y
+            rect.size = image.get_size()
+        self.count = len(bullets)
+
+    def draw(self, surface):
+        """
+        Draw all the bullets in one batched blit.
+        :pygame.surface surface: The surface on which to draw the bullets.
+        :return: None
+        """
+        if hasattr(surface, "blits"):
+            surface.blits(islice(self.entries, self.count), False)
+        else:  # Older PyGame without Surface.blits
+            for image, rect in islice(self.entries, self.count):
+                surface.blit(image, rect)
+
+
+class Hud(object):
+    """
+    Retained-mode HUD. Health bars (including the background under them) and text are composed into surfaces once and
+    only rebuilt when the value they show changes, so a steady-state frame costs a handful of blits.
+    """
+    LEFT_BAR_POS = (5, 5)
+    RIGHT_BAR_POS = (X_DIM - 5 - 200, 5)
+
+    def __init__(self, max_labels=64):
+        self.max_labels = max_labels
+        self.health_bars = dict()  # True for the left bar, False for the right -> (player, health, composed surface)
+        self.labels = dict()  # (font, text, colour) -> rendered surface
+
+    def label(self, font, text, colour):
+        """
+        Get rendered text, rendering it the first time it's needed.
+        :pygame.font.Font font: Font to render with
+        :str text: Text to render
+        :tuple colour: Colour of the text
+        :return: pygame.Surface
+        """
+        key = (font, text, colour)
+        surface = self.labels.get(key)
+        if surface is None:
+            if len(self.labels) >= self.max_labels:
+                self.labels.clear()
+            surface = self.labels[key] = font.render(text, 1, colour)
+        return surface
+
+    def health_bar(self, left, player, health):
+        """
+        Get a player's health bar, composing it if the player or their health has changed.
+        :bool left: True for the bar on the left (filling from the left), False for the one on the right
+        :str player: Player ID ("p1", "p2", ...)
+        :int health: The player's health
+        :return: pygame.Surface
+        """
+        cached = self.health_bars.get(left)
+        if cached is not None and cached[0] == player and cached[1] == health:
+            return cached[2]
+        pos = self.LEFT_BAR_POS if left else self.RIGHT_BAR_POS
+        bar = pygame.Surface(healthbar.get_size()).convert()
+        bar.blit(background_image, (0, 0), pygame.Rect(pos, healthbar.get_size()))
+        bar.blit(healthbar, (0, 0))
+        if left:
+            for health_increments in range(health):
+                bar.blit(healthbar_slices, (health_increments + 3, 3))
+            bar.blit(self.label(fnt, player.upper() + " health", BLACK), (5, 2))
+        else:
+            for health_increments in range(health):
+                bar.blit(healthbar_slices, (196 - health_increments, 3))
+            bar.blit(self.label(fnt, player.upper() + " health", BLACK), (135, 2))
+        self.health_bars[left] = (player, health, bar)
+        return bar
+
+    def draw(self, surface, bars, standings, status, players):
+        """
+        Draw the HUD.
+        :pygame.surface surface: The surface on which to draw.
+        :tuple bars: (player ID, health) for the left health bar and, optionally, the right one
+        :str standings: Text shown on the right instead of a second health bar (None for no text)
+        :str status: Connection status label
+        :str players: Player status label
+        :return: None
+        """
+        surface.blit(self.health_bar(True, *bars[0]), self.LEFT_BAR_POS)
+        if len(bars) > 1:
+            surface.blit(self.health_bar(False, *bars[1]), self.RIGHT_BAR_POS)
+        if standings is not None:
+            surface.blit(self.label(fnt, standings, WHITE), self.RIGHT_BAR_POS)
+        surface.blit(self.label(fnt, status, WHITE), [10, 25])
+        surface.blit(self.label(fnt, players, WHITE), [10, 40])
 
 
 class TinySpaceBattles(object):
     """
     The main client class, used primarily on the client.
     """
-    def __init__(self):
+    def __init__(self, dirty_rects=False):
+        """
+        Set up the game.
+        :bool dirty_rects: Redraw only the parts of the screen that change each frame
+        :return: None
+        """
+        init_display()
         self.statusLabel = "Connecting"
         self.playersLabel = "Waiting for player"
         self.winLoseLabel = ''
         self.restartLabel = 'Press Home button or j key to restart'
         self.frame = 0
-        self.player_list = pygame.sprite.Group()
-        self.bullet_list = pygame.sprite.Group() # Don't use the bullet list in players (no need to be separate lists)
-        self.p1 = Starship()
-        self.p1.set_p1(True)
-        self.p2 = Starship()
-        self.p2.set_p2(True)
+        self.bullet_pool = BulletPool()  # Every bullet in the match
+        self.ships = dict()  # Player ID -> Starship, for every player in the match
+        self.player = None  # This client's player ID (None until the server assigns one)
+        self.players = PLAYERS  # Number of seats in the match
+        self.kills = 0
         self.wiimote = None
-        self.is_p1 = None
         self.game_over = False
         self.has_won = False
+        self.dirty_rects = dirty_rects
+        self.hud = Hud()
+        self.prev_state = None  # What was drawn last frame (dirty-rect mode only)
         self.wiimote_init()
 
     def wiimote_init(self):
@@ -262,19 +409,65 @@ class TinySpaceBattles(object):
 
     def which_player(self):
         """
-        Returns a string containing "p1" or "p2" depending on which player the client is.
+        Returns a string containing the client's player ID ("p1", "p2", ...).
         :return: string
         """
-        return str("p1") if self.is_p1 else str("p2")
+        return self.player
+
+    def join(self, player, players=PLAYERS):
+        """
+        Take a seat in a match.
+        :str player: Player ID assigned by the server
+        :int players: Number of seats in the match
+        :return: None
+        """
+        self.player = player
+        self.players = players
+        self.ships = dict()
+        self.kills = 0
+        self.ship(player)
 
-    def win_or_lose(self, player):
+    def ship(self, player):
+        """
+        Get a player's ship, creating it the first time the player is seen.
+        :str player: Player ID
+        :return: Starship
+        """
+        ship = self.ships.get(player)
+        if ship is None:
+            ship = self.ships[player] = Starship()
+            ship.set_slot(player_slot(player), self.players)
+        return ship
+
+    def set_health(self, health):
+        """
+        Update every player's health.
+        :list health: Health of the ship in each seat (None for an empty seat)
+        :return: None
+        """
+        for slot, ship_health in enumerate(health):
+            player = player_name(slot)
+            if ship_health is not None:
+                self.ship(player).health = ship_health
+            elif player in self.ships and player != self.player:
+                del self.ships[player]
+
+    def visible_ships(self):
+        """
+        Ships to draw, in seat order. Destroyed ships are hidden until the game is over.
+        :return: list of Starship
+        """
+        return [self.ships[player] for player in sorted(self.ships, key=player_slot)
+                if self.game_over or self.ships[player].health > 0]
+
+    def win_or_lose(self, winner):
         """
         Handles and notifies players of win/lose events.
-        :param player: The player that has died according to the server.
+        :param winner: The last player standing according to the server (None if nobody survived).
         :return: None
         """
         self.game_over = True
-        if (self.is_p1 and player == 'p2') or (not self.is_p1 and player == 'p1'):
+        if winner is not None and winner == self.player:
             self.has_won = True
             self.winLoseLabel = 'You won!'
         else:
@@ -282,18 +475,11 @@ class TinySpaceBattles(object):
 
     def update_bullets(self, bullets):
         """
-        Uses a list of bullet locations and angles to generate bullets for client
+        Uses a list of bullet locations and angles to position the client's bullets
         :list bullets: All bullet locations with each location entry a list [x, y, angle]
         :return: None
         """
-        self.bullet_list.empty()
-        for loc in bullets:
-            bullet = Bullet(loc[2])
-            # Set the bullet's position
-            bullet.rect.x = loc[0]
-            bullet.rect.y = loc[1]
-            # Add the bullet to the list
-            self.bullet_list.add(bullet)
+        self.bullet_pool.update(bullets)
 
     def check_for_wiimote_move(self):
         """
@@ -326,9 +512,9 @@ class TinySpaceBattles(object):
                 if self.wiimote.get_button(button):
                     move.add(wiimote_move[button])
             if x_mag or y_mag:
-                self.Player_move(move, pow(x_mag, 2), pow(y_mag, 2))
+                self.player_move(move, pow(x_mag, 2), pow(y_mag, 2))
             elif move:
-                self.Player_move(move)
+                self.player_move(move)
 
     def events(self):
         """
@@ -361,54 +547,132 @@ class TinySpaceBattles(object):
                 elif button in wiimote_restart and self.game_over:
                     self.player_restart()
 
+    def draw_hud(self, surface):
+        """
+        Draws the health bars and connection and player status.
+        :pygame.surface surface: The surface on which to draw.
+        :return: None
+        """
+        self.hud.draw(surface, *self.hud_state())
+
+    def hud_state(self):
+        """
+        Everything the HUD depends on, used to tell when it needs redrawing. Duels show both players' health, while
+        free-for-alls show this client's health and how the battle is going.
+        :return: tuple of Hud.draw() arguments
+        """
+        if self.players == 2:
+            bars = tuple((player, self.ships[player].health if player in self.ships else MAX_HEALTH)
+                         for player in ("p1", "p2"))
+            standings = None
+        else:
+            player = self.player or "p1"
+            bars = ((player, self.ships[player].health if player in self.ships else MAX_HEALTH),)
+            alive = sum(1 for ship in self.ships.itervalues() if ship.health > 0)
+            standings = "Ships left: " + str(alive) + "   Kills: " + str(self.kills)
+        return bars, standings, self.statusLabel, self.playersLabel
+
+    def draw_sprites(self, surface):
+        """
+        Draws every player and all bullets.
+        :pygame.surface surface: The surface on which to draw.
+        :return: None
+        """
+        self.bullet_pool.draw(surface)
+        for ship in self.visible_ships():
+            ship.draw(surface)
+
+    def sprite_state(self):
+        """
+        The image and screen area of every player and bullet, used to tell what has changed between frames.
+        :return: list of (image, (x, y, width, height)) tuples
+        """
+        state = [(image, tuple(rect)) for image, rect in islice(self.bullet_pool.entries, len(self.bullet_pool))]
+        state.extend((ship.image, tuple(ship.rect)) for ship in self.visible_ships())
+        return state
+
+    def draw_game_over(self, surface):
+        """
+        Draws the game over overlay and text.
+        :pygame.surface surface: The surface on which to draw.
+        :return: None
+        """
+        # Transparency overlay
+        surface.blit(win_lose_bg_image, [0, 0])
+
+        # Win/lose font
+        text = self.hud.label(fnt_big, self.winLoseLabel, WHITE)
+        textpos = text.get_rect()
+        textpos.centerx = background_image.get_rect().centerx
+        textpos.centery = background_image.get_rect().centery - 200
+        surface.blit(text, textpos)
+
+        # Restart font
+        text = self.hud.label(fnt_med, self.restartLabel, WHITE)
+        textpos = text.get_rect()
+        textpos.centerx = background_image.get_rect().centerx
+        textpos.centery = background_image.get_rect().centery + 100
+        surface.blit(text, textpos)
+
     def draw(self):
         """
         Draws all the art assets (both players, health bars, background, game over, etc.) for the client
         :return: None
         """
+        if self.dirty_rects:
+            self.draw_dirty()
+            return
+
         #Draw background image
         screen.blit(background_image, [0, 0])
-
-        # P1 health
-        screen.blit(healthbar, [5, 5])
-        for health_increments in range(self.p1.health):
-            screen.blit(healthbar_slices, (health_increments + 8, 8))
-        screen.blit(fnt.render("P1 health", 1, BLACK), [10, 7])
-
-        # P2 health
-        screen.blit(healthbar, [X_DIM - 5 - 200, 5])
-        for health_increments in range(self.p2.health):
-            screen.blit(healthbar_slices, (X_DIM - health_increments + 8 - 17, 8))
-        screen.blit(fnt.render("P2 health", 1, BLACK), [X_DIM - 10 - 60, 7])
-
-        # Draw connection and player status
-        screen.blit(fnt.render(self.statusLabel, 1, WHITE), [10, 25])
-        screen.blit(fnt.render(self.playersLabel, 1, WHITE), [10, 40])
+        self.draw_hud(screen)
 
         # Draw players and bullets
-        self.bullet_list.draw(screen)
-        self.p1.draw(screen)
-        self.p2.draw(screen)
+        self.draw_sprites(screen)
 
         # If game over, notify player
         if self.game_over:
-            # Transparency overlay
-            screen.blit(win_lose_bg_image, [0, 0])
-
-            # Win/lose font
-            text = fnt_big.render(self.winLoseLabel, 1, WHITE)
-            textpos = text.get_rect()
-            textpos.centerx = background_image.get_rect().centerx
-            textpos.centery = background_image.get_rect().centery - 200
-            screen.blit(text, textpos)
-
-            # Restart font
-            text = fnt_med.render(self.restartLabel, 1, WHITE)
-            textpos = text.get_rect()
-            textpos.centerx = background_image.get_rect().centerx
-            textpos.centery = background_image.get_rect().centery + 100
-            screen.blit(text, textpos)
+            self.draw_game_over(screen)
 
         pygame.display.flip()
 
+    def draw_dirty(self):
+        """
+        Dirty-rectangle version of draw(). Only the areas the players and bullets covered last frame and cover now
+        (plus the HUD if it has changed or been drawn over) are restored, redrawn and pushed to the display. Nothing is
+        drawn if nothing has changed.
+        :return: None
+        """
+        state = (self.sprite_state(), self.hud_state(), self.game_over)
+        if state == self.prev_state:
+            return
+        prev_state, self.prev_state = self.prev_state, state
+
+        # The game over overlay is translucent, so while it's up (and on the first frame) redraw everything
+        if prev_state is None or self.game_over or prev_state[2]:
+            screen.blit(background_image, [0, 0])
+            self.draw_hud(screen)
+            self.draw_sprites(screen)
+            if self.game_over:
+                self.draw_game_over(screen)
+            pygame.display.flip()
+            return
+
+        dirty = [pygame.Rect(rect) for image, rect in prev_state[0]]
+        dirty.extend(pygame.Rect(rect) for image, rect in state[0])
+        if len(dirty) > MAX_DIRTY_RECTS:
+            # Too many small updates, so update the whole screen in one go instead
+            dirty = [screen.get_rect()]
+        redraw_hud = state[1] != prev_state[1] or any(rect.collidelist(dirty) != -1 for rect in HUD_RECTS)
+        if redraw_hud:
+            dirty.extend(HUD_RECTS)
+
+        # Restore the background under everything that changed, then redraw on top of it
+        for rect in dirty:
+            screen.blit(background_image, rect, rect)
+        if redraw_hud:
+            self.draw_hud(screen)
+        self.draw_sprites(screen)
+
+        pygame.display.update(dirty)
 
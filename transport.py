@@ -0,0 +1,393 @@
+"""
+Event-driven TCP transport for the server, used in place of PodSixNet's asyncore-based Server and Channel.
+
+Sockets are watched with epoll where it's available (Linux), falling back to poll() elsewhere, so the cost of waiting
+for traffic doesn't grow with the number of connections and one process can hold thousands of them. Messages are
+framed exactly like PodSixNet's (rencode followed by "\\0---\\0") and dispatched to the same Network_<action>
+callbacks, so clients are unchanged.
+
+Each connection buffers what it reads until a whole message has arrived, and buffers what it sends until the socket
+can take it. Messages sent during a tick are written together when the server is pumped, usually in one system call,
+and a message that hasn't been written yet is dropped if a newer one on the same stream (e.g. a later position of the
+same ship) replaces it.
+"""
+import sys
+import errno
+import select
+import socket
+import traceback
+from PodSixNet.rencode import loads, dumps
+
+TERMINATOR = "\0---\0"
+
+# Most bytes read from a socket at a time
+READ_SIZE = 65536
+
+# A client whose unread or unsent data grows past these sizes is disconnected, so one slow or misbehaving client
+# can't use up the server's memory
+MAX_READ_BUFFER = 1 << 20
+MAX_WRITE_BUFFER = 4 << 20
+
+# Errors that just mean "try again later" on a non-blocking socket
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def encode(data):
+    """
+    Encode a message for sending, e.g. to encode it once when it's going to many clients.
+    :dict data: Message to encode
+    :return: Encoded message, including the terminator
+    """
+    return dumps(data) + TERMINATOR
+
+
+def raise_fd_limit():
+    """
+    Raise the limit on open files to the most allowed, since each connection uses a file descriptor.
+    :return: New limit, or None if it couldn't be changed
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+class Reactor(object):
+    """
+    Waits for sockets to become readable or writable and calls their handlers' handle_read() and handle_write().
+    """
+    def __init__(self):
+        self.handlers = dict()  # File descriptor -> handler
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._read = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._write = select.EPOLLOUT
+            self._timeout_scale = 1  # epoll takes seconds
+        else:
+            self._poller = select.poll()
+            self._read = select.POLLIN | select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self._write = select.POLLOUT
+            self._timeout_scale = 1000  # poll takes milliseconds
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def register(self, fd, handler):
+        """
+        Start watching a socket for incoming data.
+        :int fd: File descriptor of the socket
+        :handler: Object with handle_read(), handle_write() and handle_error() methods
+        :return: None
+        """
+        self.handlers[fd] = handler
+        self._poller.register(fd, self._read)
+
+    def want_write(self, fd, write):
+        """
+        Start or stop watching a socket for room to send more data.
+        :int fd: File descriptor of the socket
+        :bool write: True to watch for writability as well as incoming data
+        :return: None
+        """
+        self._poller.modify(fd, self._read | self._write if write else self._read)
+
+    def unregister(self, fd):
+        """
+        Stop watching a socket.
+        :int fd: File descriptor of the socket
+        :return: None
+        """
+        if self.handlers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def wait(self, timeout):
+        """
+        Block until at least one socket is ready or the timeout expires, then handle every socket that's ready.
+        :float timeout: Most time to wait in seconds
+        :return: None
+        """
+        try:
+            events = self._poller.poll(max(0, timeout) * self._timeout_scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, event in events:
+            handler = self.handlers.get(fd)
+            if handler is None:
+                continue  # Closed while handling an earlier event
+            try:
+                if event & self._read:
+                    handler.handle_read()
+                if event & self._write and self.handlers.get(fd) is handler:
+                    handler.handle_write()
+            except Exception:
+                handler.handle_error()
+
+
+class Channel(object):
+    """
+    A single client connection. Subclasses handle messages with Network_<action>(data) methods (and Network(data) for
+    every message) and can define Close() to be told when the connection closes, as with PodSixNet's Channel.
+    """
+    def __init__(self, conn, addr, server):
+        """
+        Wrap an accepted socket.
+        :socket.socket conn: Connected socket
+        :tuple addr: Address of the client
+        :Server server: Server that accepted the connection
+        :return: None
+        """
+        self.socket = conn
+        self.addr = addr
+        self._server = server
+        self._fd = conn.fileno()
+        self._ibuffer = ""
+        self._obuffer = list()  # Encoded messages waiting to be sent
+        self._obuffer_size = 0
+        self._streams = dict()  # Stream -> index in _obuffer of the last message queued on it
+        self._writing = False  # True while waiting for room in the socket's send buffer
+        self.closed = False
+
+    def fileno(self):
+        return self._fd
+
+    def Send(self, data, stream=None, barrier=False):
+        """
+        Queue a message to send. It's written to the socket the next time the server is pumped.
+        :dict data: Message to send
+        :int stream: Stream the message belongs to if a newer message can replace it (see wire.stream())
+        :bool barrier: True if messages sent after it must not arrive before it (see wire.is_barrier())
+        :return: Number of bytes queued
+        """
+        outgoing = encode(data)
+        if self._server.metrics is not None:
+            self._server.metrics.count_sent(data["action"], len(outgoing))
+        return self.send_encoded(outgoing, stream, barrier)
+
+    def send_encoded(self, outgoing, stream=None, barrier=False):
+        """
+        Queue a message that has already been encoded. If a message queued earlier on the same stream hasn't been
+        written yet, it's dropped and this one is queued after everything else.
+        :str outgoing: Message from encode()
+        :int stream: Stream the message belongs to if a newer message can replace it
+        :bool barrier: True if messages sent after it must not arrive before it (always the case over TCP)
+        :return: Number of bytes queued
+        """
+        if self.closed:
+            return 0
+        if not self._obuffer or self._obuffer_size > MAX_WRITE_BUFFER:
+            self._server.pending.add(self)  # Over the limit, flush() disconnects the client unless it catches up
+        if stream is not None:
+            index = self._streams.get(stream)
+            if index is not None:
+                self._obuffer_size -= len(self._obuffer[index])
+                self._obuffer[index] = ""
+            self._streams[stream] = len(self._obuffer)
+        self._obuffer.append(outgoing)
+        self._obuffer_size += len(outgoing)
+        return len(outgoing)
+
+    def flush(self):
+        """
+        Write as much queued data as the socket will take, waiting for it to become writable if there's any left over.
+        :return: None
+        """
+        if self.closed or not self._obuffer:
+            return
+        data = self._obuffer[0] if len(self._obuffer) == 1 else "".join(self._obuffer)
+        self._streams = dict()
+        try:
+            sent = self.socket.send(data)
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                self.close()
+                return
+            sent = 0
+        if sent == len(data):
+            self._obuffer = list()
+            self._obuffer_size = 0
+        else:
+            self._obuffer = [data[sent:]]
+            self._obuffer_size = len(data) - sent
+            if self._obuffer_size > MAX_WRITE_BUFFER:
+                print "Disconnecting " + str(self.addr) + ": too far behind"
+                self.close()
+                return
+        writing = bool(self._obuffer)
+        if writing != self._writing:
+            self._writing = writing
+            self._server.reactor.want_write(self._fd, writing)
+
+    def handle_write(self):
+        self.flush()
+
+    def handle_read(self):
+        """
+        Read whatever has arrived and handle every complete message.
+        :return: None
+        """
+        try:
+            chunk = self.socket.recv(READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            chunk = ""
+        if not chunk:
+            self.close()
+            return
+        messages = (self._ibuffer + chunk).split(TERMINATOR)
+        self._ibuffer = messages.pop()
+        if len(self._ibuffer) > MAX_READ_BUFFER:
+            print "Disconnecting " + str(self.addr) + ": message too long"
+            self.close()
+            return
+        for message in messages:
+            if self.closed:
+                break
+            self.found_message(message)
+
+    def found_message(self, message):
+        """
+        Decode a message and hand it to the matching Network_<action> callback and Network().
+        :str message: Encoded message (without the terminator)
+        :return: None
+        """
+        data = loads(message)
+        if type(data) is dict and 'action' in data:
+            if self._server.metrics is not None:
+                self._server.metrics.count_received(data, len(message))
+            for name in ('Network_' + data['action'], 'Network'):
+                if hasattr(self, name):
+                    getattr(self, name)(data)
+        else:
+            print "OOB data:", data
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+    def close(self):
+        """
+        Close the connection (if it isn't already) and call Close() if it's defined.
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._obuffer = list()
+        self._server.remove_channel(self)
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        if hasattr(self, "Close"):
+            self.Close()
+
+
+class Server(object):
+    """
+    Listens for connections and creates a channelClass for each one. Call wait() to handle traffic as it arrives and
+    Pump() to send queued messages. Connections accepted elsewhere (e.g. by another process) can be handed over with
+    adopt().
+    """
+    channelClass = Channel
+
+    def __init__(self, channelClass=None, localaddr=("127.0.0.1", 5071), listeners=socket.SOMAXCONN):
+        """
+        Start listening.
+        :type channelClass: Channel subclass to create for each connection
+        :tuple localaddr: (host, port) to listen on (None to only take connections handed over with adopt())
+        :int listeners: Most connections waiting to be accepted
+        :return: None
+        """
+        if channelClass:
+            self.channelClass = channelClass
+        self.channels = set()
+        self.pending = set()  # Channels with messages waiting to be sent
+        self.metrics = None  # Counts messages sent and received when set (see metrics.Metrics)
+        self.reactor = Reactor()
+        self.socket = None
+        if localaddr is not None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(localaddr)
+            self.socket.listen(listeners)
+            self.socket.setblocking(False)
+            self.reactor.register(self.socket.fileno(), self)
+
+    def handle_read(self):
+        """
+        Accept every waiting connection.
+        :return: None
+        """
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK + (errno.ECONNABORTED,):
+                    sys.stderr.write("warning: server accept() failed: " + str(e) + "\n")
+                return
+            self.adopt(conn, addr)
+
+    def adopt(self, conn, addr):
+        """
+        Start serving a connected socket.
+        :socket.socket conn: Connected socket
+        :tuple addr: Address of the client
+        :return: The new channel
+        """
+        conn.setblocking(False)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel = self.channelClass(conn, addr, self)
+        self.reactor.register(channel.fileno(), channel)
+        return self.add_channel(channel)
+
+    def add_channel(self, channel):
+        """
+        Start serving a new channel and tell the client it's connected.
+        :Channel channel: New channel
+        :return: The channel
+        """
+        self.channels.add(channel)
+        channel.Send({"action": "connected"})
+        if hasattr(self, "Connected"):
+            self.Connected(channel, channel.addr)
+        return channel
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self):
+        traceback.print_exc()
+
+    def remove_channel(self, channel):
+        """
+        Forget a closed channel.
+        :Channel channel: Channel that has closed
+        :return: None
+        """
+        self.channels.discard(channel)
+        self.pending.discard(channel)
+        self.reactor.unregister(channel.fileno())
+
+    def Pump(self):
+        """
+        Send every queued message.
+        :return: None
+        """
+        pending, self.pending = self.pending, set()
+        for channel in pending:
+            channel.flush()
+
+    def wait(self, timeout):
+        """
+        Block until network traffic arrives or the timeout expires, handling any traffic that arrives.
+        :float timeout: Most time to wait in seconds
+        :return: None
+        """
+        self.reactor.wait(timeout)
@@ -0,0 +1,175 @@
+"""
+Compact binary encoding for the high-frequency "move", "bullets", "cmd" and "state" messages.
+
+Packed messages travel inside a small {"action": "bin", "d": payload} envelope so PodSixNet can still frame and
+dispatch them. The struct-packed payload is base64 encoded because PodSixNet separates messages with "\\0---\\0" and
+newer releases decode every string as UTF-8. Receivers always understand both formats; the "binary" flag only
+controls what is sent, so the plain dict format can be switched back on for debugging.
+"""
+import struct
+from binascii import a2b_base64, b2a_base64
+
+# Bumped whenever the layout of a packed message changes
+WIRE_VERSION = 4
+
+# Message types
+MOVE = 1
+BULLETS = 2
+COMMAND = 3
+STATE = 4
+
+# Stream shared by bullet updates and their acknowledgements (move and state messages use the player number as their
+# stream)
+SNAPSHOT_STREAM = 0
+
+# Send move, bullets, cmd and state messages packed (False falls back to plain dicts)
+binary = True
+
+HEADER = struct.Struct("!BB")  # Version, message type
+MOVE_BODY = struct.Struct("!BhhH")  # Player number, x, y, angle (tenths of a degree)
+BULLETS_BODY = struct.Struct("!BH")  # Player count, bullet count (followed by each player's health, then the bullets)
+COMMAND_BODY = struct.Struct("!IhhbB")  # Frame number, dx, dy, turn, buttons
+STATE_BODY = struct.Struct("!I")  # Last frame number applied (after a move body)
+
+# Sent in place of the health of an empty seat
+NO_HEALTH = -32768
+
+# Ship angles are sent in tenths of a degree
+ANGLE_SCALE = 10
+
+# Each bullet is packed into 32 bits: 11 bits each for x and y (offset so slightly off-screen bullets fit) and
+# 10 bits for the angle
+BULLET_OFFSET = 16
+BULLET_COORD_MAX = (1 << 11) - 1
+BULLET_ANGLES = 1 << 10
+
+
+def is_packable(data):
+    """
+    Check if a message has a packed form.
+    :dict data: Message to check
+    :return: True if the message can be packed
+    """
+    return data["action"] in ("move", "bullets", "cmd", "state")
+
+
+def stream(data):
+    """
+    Find the stream a message belongs to. Each message on a stream replaces the one before, so over an unreliable
+    transport a lost or late message can be dropped instead of resent.
+    :dict data: Message to check (before it's packed)
+    :return: Stream number, or None if the message has to arrive
+    """
+    if data["action"] in ("move", "state"):
+        return int(data["p"][1:])
+    elif data["action"] in ("bullets", "delta", "ack"):
+        return SNAPSHOT_STREAM
+    return None
+
+
+def is_barrier(data):
+    """
+    Check if a message resets what later stream messages build on (joining a match, a restart, or a seat being
+    emptied), so over an unreliable transport they're held back until it has arrived. Other messages that have to
+    arrive don't hold them up.
+    :dict data: Message to check (before it's packed)
+    :return: True if stream messages sent after it must not be delivered before it
+    """
+    return data["action"] in ("init", "restart", "player_left")
+
+
+def pack(data):
+    """
+    Pack a move, bullets, cmd or state message.
+    :dict data: Message to pack
+    :return: Envelope dict containing the packed message
+    """
+    if data["action"] == "move":
+        payload = HEADER.pack(WIRE_VERSION, MOVE) + pack_move(data)
+    elif data["action"] == "bullets":
+        payload = HEADER.pack(WIRE_VERSION, BULLETS) + pack_bullets(data)
+    elif data["action"] == "cmd":
+        payload = HEADER.pack(WIRE_VERSION, COMMAND) + pack_command(data)
+    elif data["action"] == "state":
+        payload = HEADER.pack(WIRE_VERSION, STATE) + pack_move(data) + STATE_BODY.pack(data["n"])
+    else:
+        raise ValueError("Can't pack action " + str(data["action"]))
+    return {"action": "bin", "d": b2a_base64(payload)[:-1]}  # Drop the trailing newline
+
+
+def unpack(data):
+    """
+    Unpack an envelope produced by pack().
+    :dict data: Envelope dict
+    :return: The original message
+    """
+    payload = a2b_base64(str(data["d"]))
+    version, kind = HEADER.unpack_from(payload)
+    if version != WIRE_VERSION:
+        raise ValueError("Unsupported wire version " + str(version))
+    if kind == MOVE:
+        return unpack_move(payload, HEADER.size)
+    elif kind == BULLETS:
+        return unpack_bullets(payload, HEADER.size)
+    elif kind == COMMAND:
+        return unpack_command(payload, HEADER.size)
+    elif kind == STATE:
+        return unpack_state(payload, HEADER.size)
+    raise ValueError("Unknown message type " + str(kind))
+
+
+def clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+
+def pack_move(data):
+    x, y, angle = data["p_pos"]
+    return MOVE_BODY.pack(int(data["p"][1:]),
+                          clamp(x, -32768, 32767),
+                          clamp(y, -32768, 32767),
+                          int(round(angle * ANGLE_SCALE)) % (360 * ANGLE_SCALE))
+
+
+def unpack_move(payload, offset):
+    player, x, y, angle = MOVE_BODY.unpack_from(payload, offset)
+    return {"action": "move", "p": "p" + str(player), "p_pos": [x, y, float(angle) / ANGLE_SCALE]}
+
+
+def pack_bullets(data):
+    bullets = data["bullets"]
+    health = [NO_HEALTH if h is None else clamp(h, NO_HEALTH + 1, 32767) for h in data["health"]]
+    packed = [clamp(x + BULLET_OFFSET, 0, BULLET_COORD_MAX) << 21
+              | clamp(y + BULLET_OFFSET, 0, BULLET_COORD_MAX) << 10
+              | int(round(angle * BULLET_ANGLES / 360.0)) % BULLET_ANGLES
+              for (x, y, angle) in bullets]
+    return BULLETS_BODY.pack(len(health), len(bullets)) \
+        + struct.pack("!%dh%dI" % (len(health), len(packed)), *(health + packed))
+
+
+def unpack_bullets(payload, offset):
+    players, count = BULLETS_BODY.unpack_from(payload, offset)
+    values = struct.unpack_from("!%dh%dI" % (players, count), payload, offset + BULLETS_BODY.size)
+    health = [None if h == NO_HEALTH else h for h in values[:players]]
+    bullets = [((value >> 21) - BULLET_OFFSET,
+                ((value >> 10) & BULLET_COORD_MAX) - BULLET_OFFSET,
+                (value & (BULLET_ANGLES - 1)) * 360.0 / BULLET_ANGLES)
+               for value in values[players:]]
+    return {"action": "bullets", "bullets": bullets, "health": health}
+
+
+def pack_command(data):
+    dx, dy, turn = data["m"]
+    return COMMAND_BODY.pack(data["n"], clamp(dx, -32768, 32767), clamp(dy, -32768, 32767), clamp(turn, -128, 127),
+                             data["b"])
+
+
+def unpack_command(payload, offset):
+    frame, dx, dy, turn, buttons = COMMAND_BODY.unpack_from(payload, offset)
+    return {"action": "cmd", "n": frame, "m": [dx, dy, turn], "b": buttons}
+
+
+def unpack_state(payload, offset):
+    data = unpack_move(payload, offset)
+    data["action"] = "state"
+    data["n"], = STATE_BODY.unpack_from(payload, offset + MOVE_BODY.size)
+    return data